@@ -10,10 +10,15 @@ from django.conf import settings
 
 def check_session_csrf_enabled(app_configs, **kwargs):
     errors = []
-    if "session_csrf.CsrfMiddleware" not in settings.MIDDLEWARE_CLASSES:
+    middleware = tuple(settings.MIDDLEWARE_CLASSES)
+    # token authenticated API calls skip the browser middleware, everything else runs it
+    if "matches.middleware.BrowserMiddleware" in middleware:
+        middleware += tuple(getattr(settings, "BROWSER_MIDDLEWARE_CLASSES", ()))
+    if "session_csrf.CsrfMiddleware" not in middleware:
         errors.append(Error(
             "SESSION_CSRF_DISABLED",
-            hint="Please add 'session_csrf.CsrfMiddleware' to MIDDLEWARE_CLASSES",
+            hint="Please add 'session_csrf.CsrfMiddleware' to MIDDLEWARE_CLASSES "
+                 "or BROWSER_MIDDLEWARE_CLASSES",
         ))
     return errors
 
@@ -48,18 +48,24 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
-    'google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware',
     'matches.middleware.ProfileMiddleware',
     'djangae.contrib.security.middleware.AppEngineSecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'matches.middleware.BrowserMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'matches.middleware.JWTUpgradeMiddleware',
+)
+
+# run by matches.middleware.BrowserMiddleware for everything but token authenticated API calls
+BROWSER_MIDDLEWARE_CLASSES = (
+    'google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'djangae.contrib.gauth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'csp.middleware.CSPMiddleware',
     'session_csrf.CsrfMiddleware',
-    'django.middleware.security.SecurityMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
 TEMPLATES = [
@@ -160,8 +166,8 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'matches.pagination.GaePageNumberPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.BasicAuthentication',
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'matches.authentication.CachedBasicAuthentication',
+        'matches.authentication.StatelessJSONWebTokenAuthentication',
     ),
     'DEFAULT_FILTER_BACKENDS': (
         'django_filters.rest_framework.DjangoFilterBackend',
@@ -192,4 +198,17 @@ JWT_AUTH = {
 # other settings
 GCM_API_KEY = os.getenv('GCM_API_KEY')
 GCM_SERVER_KEY = os.getenv('GCM_SERVER_KEY')
+GCM_URL = os.getenv('GCM_URL', 'https://gcm-http.googleapis.com/gcm/send')
 PUBSUB_NOTIFICATIONS_TOPIC = 'notifications'
+TASK_QUEUE_CLASS = 'matches.tasks.TaskQueue'
+MATCH_SCHEDULER_QUEUE = 'match-deadlines'
+NOTIFICATIONS_QUEUE = 'notifications'
+AVATARS_QUEUE = 'avatars'
+IMAGES_QUEUE = 'images'
+RECONCILE_QUEUE = 'reconcile'
+UPLOAD_STORAGE_CLASS = 'matches.uploads.CloudStorageUploads'
+GRAVATAR_URL = os.getenv('GRAVATAR_URL', 'https://www.gravatar.com/avatar/')
+# share of requests profiled by matches.middleware.ProfileMiddleware, and the seconds
+# over which their stats are aggregated
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', .01))
+PROFILE_WINDOW = 15 * 60
@@ -31,10 +31,12 @@ DEBUG = False
 MIDDLEWARE_CLASSES = list(MIDDLEWARE_CLASSES)
 if 'google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware' in MIDDLEWARE_CLASSES:
     MIDDLEWARE_CLASSES.remove('google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware')
-if 'matches.middleware.ProfileMiddleware' in MIDDLEWARE_CLASSES:
-    MIDDLEWARE_CLASSES.remove('matches.middleware.ProfileMiddleware')
 MIDDLEWARE_CLASSES = tuple(MIDDLEWARE_CLASSES)
 
+BROWSER_MIDDLEWARE_CLASSES = tuple(
+    path for path in BROWSER_MIDDLEWARE_CLASSES
+    if path != 'google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware')
+
 # Remove unsafe-inline from CSP_STYLE_SRC. It's there in default to allow
 # Django error pages in DEBUG mode render necessary styles
 if "'unsafe-inline'" in CSP_STYLE_SRC:
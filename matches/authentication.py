@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+'''stateless JWT authentication: the principal is built from the verified claims'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.crypto import get_random_string
+from django.utils.functional import SimpleLazyObject
+from future.utils import python_2_unicode_compatible
+from rest_framework.authentication import BasicAuthentication
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings
+
+LOGGER = logging.getLogger(__name__)
+
+# replaced whenever a user's password changes, verified credentials of other versions are
+# void; a version missing from the cache voids all of them
+CREDENTIALS_VERSION_KEY = 'credentials-version-{}'
+CREDENTIALS_VERSION_TIMEOUT = 60 * 60 * 24
+# response header with a token for clients still sending their password
+UPGRADE_HEADER = 'X-JWT-Token'
+
+
+class LazyPlayer(SimpleLazyObject):
+    '''the player with the given pk, loaded from the datastore on first use of anything but pk'''
+
+    def __init__(self, pk):
+        def load():
+            from .models import Player
+            # pylint: disable=no-member
+            return Player.objects.get(pk=pk)
+
+        super(LazyPlayer, self).__init__(load)
+        # instance attributes are found without going through the lazy proxy
+        self.__dict__['pk'] = pk
+        self.__dict__['id'] = pk
+
+    def __repr__(self):
+        return '<LazyPlayer: {}>'.format(self.__dict__['pk'])
+
+    # a player always exists, checks like "if player" need not load it
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+
+@python_2_unicode_compatible
+class TokenPrincipal(object):
+    '''
+    authenticated user from the claims of a verified token: the user and player pks
+    and the username are known without a datastore read, anything else loads the user
+    '''
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.pk = self.id = payload['user_id']
+        self.username = payload.get('username')
+        self.player_pk = payload['pk']
+        self.player = LazyPlayer(self.player_pk)
+        self._user = None
+
+    @property
+    def user(self):
+        if self._user is None:
+            # pylint: disable=invalid-name
+            User = get_user_model()
+            self._user = User.objects.get(pk=self.pk)
+        return self._user
+
+    def __getattr__(self, name):
+        # only called for attributes not set above, e.g. is_staff or email
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    # pylint: disable=no-self-use
+    def is_authenticated(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def get_username(self):
+        return self.username
+
+    def __str__(self):
+        return self.username or str(self.pk)
+
+    def __repr__(self):
+        return '<TokenPrincipal: {} (player {})>'.format(self.pk, self.player_pk)
+
+
+class StatelessJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    '''
+    JWT authentication without loading the user: tokens issued by matches.utils.jwt_payload
+    carry the player pk, so the signature and expiry are all that is checked; a deactivated
+    user keeps access until their token expires. Older tokens load the user as before.
+    '''
+
+    def authenticate_credentials(self, payload):
+        if payload.get('pk') is None or payload.get('user_id') is None:
+            return super(StatelessJSONWebTokenAuthentication,
+                         self).authenticate_credentials(payload)
+
+        return TokenPrincipal(payload)
+
+
+class VerificationCache(object):
+    '''
+    bounded LRU of verified credentials with a time to live, local to the instance;
+    keyed by an HMAC of the credentials, so no password is kept in memory
+    '''
+
+    def __init__(self, max_size=1000, timeout=5 * 60):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(userid, password):
+        message = '{}\0{}'.format(userid, password).encode('utf-8')
+        return hmac.new(settings.SECRET_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                return None
+            # most recently used last
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.timeout, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_pk):
+        with self._lock:
+            for key, (_, value) in list(self._entries.items()):
+                if value['payload']['user_id'] == user_pk:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+VERIFICATIONS = VerificationCache()
+
+
+def _version_key(username):
+    # clients may send any case variant of a username, all share one version
+    return CREDENTIALS_VERSION_KEY.format((username or '').lower())
+
+
+def credentials_version(username):
+    return cache.get(_version_key(username))
+
+
+def invalidate_credentials(user, username=None):
+    '''
+    void cached verifications of the user's password on all instances; call on
+    set_password, and with the previous username when it changes
+    '''
+
+    cache.set(_version_key(username or user.get_username()),
+              get_random_string(12), CREDENTIALS_VERSION_TIMEOUT)
+    VERIFICATIONS.discard(user.pk)
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+    '''
+    basic authentication that runs the password hasher only once per credentials and
+    cache timeout: later requests get the principal of the cached token claims after
+    one memcache read of the credentials version, which has to match the one stored
+    with the verification. Responses carry a JWT in the
+    X-JWT-Token header (see JWTUpgradeMiddleware), so clients can stop sending passwords.
+    '''
+
+    request = None
+
+    def authenticate(self, request):
+        # authenticators are instantiated for every request
+        self.request = request
+        return super(CachedBasicAuthentication, self).authenticate(request)
+
+    # pylint: disable=unused-argument
+    def authenticate_credentials(self, userid, password, request=None):
+        key = VerificationCache.key(userid, password)
+        # read before verifying, so a concurrent password change voids the new entry
+        version = credentials_version(userid)
+        entry = VERIFICATIONS.get(key)
+
+        if entry is not None and version is not None and entry['version'] == version:
+            self._offer_token(entry['token'])
+            return (TokenPrincipal(entry['payload']), None)
+
+        user, auth = super(CachedBasicAuthentication, self).authenticate_credentials(
+            userid, password)
+
+        try:
+            payload = api_settings.JWT_PAYLOAD_HANDLER(user)
+        except AttributeError:
+            # users without a player, e.g. admins, are verified every time
+            return (user, auth)
+
+        token = api_settings.JWT_ENCODE_HANDLER(payload)
+        self._offer_token(token)
+
+        if version is None:
+            # a new version, unless a password change stored one since the read above
+            version = get_random_string(12)
+            if not cache.add(_version_key(userid), version, CREDENTIALS_VERSION_TIMEOUT):
+                return (user, auth)
+
+        VERIFICATIONS.set(key, {'payload': payload, 'token': token, 'version': version})
+
+        return (user, auth)
+
+    def _offer_token(self, token):
+        # the Django request outlives the REST framework one into the middleware
+        request = getattr(self.request, '_request', self.request)
+        if request is not None:
+            request.jwt_upgrade = token
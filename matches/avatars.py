@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+'''resolution of player avatars from Gravatar, with a negative cache for missing ones'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import hashlib
+import logging
+import threading
+import time
+
+import requests
+
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger(__name__)
+
+GRAVATAR_URL = 'https://www.gravatar.com/avatar/'
+# (connect, read) timeouts in seconds
+HTTP_TIMEOUT = (3.05, 10)
+POOL_SIZE = 10
+# how long to remember that an email hash has no avatar
+MISSING_TIMEOUT = 60 * 60 * 24 * 7
+# how long to remember the image created for an email hash or content digest
+IMAGE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def email_hash(email):
+    '''the Gravatar hash of an email address'''
+
+    return hashlib.md5((email or '').strip().lower().encode('utf-8')).hexdigest()
+
+
+def content_digest(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+class AvatarFetcher(object):
+    '''
+    downloads avatars by email hash over a pooled session; hashes without an
+    avatar are remembered in the cache and not requested again for a while
+    '''
+
+    def __init__(self, url=None, timeout=HTTP_TIMEOUT, session=None, size=1080):
+        self.url = url or getattr(settings, 'GRAVATAR_URL', None) or GRAVATAR_URL
+        self.timeout = timeout
+        self.params = {'s': size, 'd': 404, 'r': 'pg'}
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'found': 0, 'missing': 0, 'skipped': 0,
+                         'errors': 0, 'seconds': 0.0}
+
+    @property
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.counters[key] += value
+
+    def source(self, gravatar):
+        return '{}/{}'.format(self.url.rstrip('/'), gravatar)
+
+    @staticmethod
+    def missing_key(gravatar):
+        return 'avatar-missing-{}'.format(gravatar)
+
+    @staticmethod
+    def image_key(gravatar):
+        return 'avatar-image-{}'.format(gravatar)
+
+    @staticmethod
+    def content_key(digest):
+        return 'avatar-content-{}'.format(digest)
+
+    def fetch(self, gravatar):
+        '''the avatar's content, or None if the hash has no avatar'''
+
+        if cache.get(self.missing_key(gravatar)):
+            self.count('skipped')
+            return None
+
+        stt = time.time()
+        try:
+            response = self.session.get(self.source(gravatar), params=self.params,
+                                        timeout=self.timeout)
+        finally:
+            self.count('requests')
+            self.count('seconds', time.time() - stt)
+
+        if response.status_code == 404:
+            cache.set(self.missing_key(gravatar), True, MISSING_TIMEOUT)
+            self.count('missing')
+            return None
+
+        try:
+            response.raise_for_status()
+        except Exception:
+            self.count('errors')
+            raise
+
+        self.count('found')
+        return response.content
+
+    def cached_images(self, gravatars):
+        '''image pks already created for the given email hashes'''
+
+        keys = {self.image_key(gravatar): gravatar for gravatar in gravatars}
+        return {keys[key]: pk for key, pk in cache.get_many(list(keys)).items()}
+
+    def cached_content(self, digest):
+        return cache.get(self.content_key(digest))
+
+    def remember(self, gravatar, digest, image_pk):
+        cache.set_many({
+            self.image_key(gravatar): image_pk,
+            self.content_key(digest): image_pk,
+        }, IMAGE_TIMEOUT)
+
+    def forget(self, gravatar):
+        cache.delete(self.image_key(gravatar))
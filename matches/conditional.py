@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+'''conditional GET: validators from last_modified and 304 responses without serializing'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import calendar
+import hashlib
+import logging
+
+# pylint: disable=redefined-builtin
+from builtins import str
+
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+from .metrics import Counters
+
+LOGGER = logging.getLogger(__name__)
+
+ENDPOINTS = ('match', 'matches', 'image', 'chat')
+CONDITIONAL_COUNTERS = Counters(
+    'conditional', ['{}-{}'.format(endpoint, outcome)
+                    for endpoint in ENDPOINTS for outcome in ('hits', 'misses')])
+
+
+def make_etag(*parts):
+    '''strong validator over the given parts, e.g. pk, last_modified and viewer'''
+
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return '"{}"'.format(digest)
+
+
+def _timestamp(last_modified):
+    return calendar.timegm(last_modified.utctimetuple()) if last_modified else None
+
+
+def is_not_modified(request, etag=None, last_modified=None):
+    '''
+    True if the client's copy is current: If-None-Match is checked first and,
+    only without it, If-Modified-Since (which has second precision)
+    '''
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+
+    if if_none_match:
+        if not etag:
+            return False
+        tags = {tag.strip() for tag in if_none_match.split(',')}
+        tags |= {tag[2:] for tag in tags if tag.startswith('W/')}
+        return '*' in tags or etag in tags
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    timestamp = _timestamp(last_modified)
+
+    return bool(if_modified_since and timestamp and timestamp <= if_modified_since)
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(_timestamp(last_modified))
+    # clients may keep the response, but must revalidate it every time
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def not_modified(request, endpoint, etag=None, last_modified=None):
+    '''a 304 response if the client's copy is current, else None; counts both outcomes'''
+
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    if is_not_modified(request, etag, last_modified):
+        CONDITIONAL_COUNTERS.incr('{}-hits'.format(endpoint))
+        return set_validators(Response(status=status.HTTP_304_NOT_MODIFIED),
+                              etag, last_modified)
+
+    CONDITIONAL_COUNTERS.incr('{}-misses'.format(endpoint))
+    return None
+
+
+def stats():
+    '''hits and misses per endpoint, with the share of requests answered with 304'''
+
+    values = CONDITIONAL_COUNTERS.get()
+    result = {}
+
+    for endpoint in ENDPOINTS:
+        hits = values['{}-hits'.format(endpoint)]
+        misses = values['{}-misses'.format(endpoint)]
+        result[endpoint] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else None,
+        }
+
+    return result
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+'''local stand-ins for external HTTP services, for offline tests and benchmarks'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import json
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+
+
+class LocalHTTPServer(object):
+    '''serves requests on localhost in a background thread, use as context manager'''
+
+    def __init__(self):
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            # pylint: disable=invalid-name
+            def do_GET(self):
+                server.dispatch(self, 'GET')
+
+            # pylint: disable=invalid-name
+            def do_POST(self):
+                server.dispatch(self, 'POST')
+
+            # pylint: disable=invalid-name
+            def do_PUT(self):
+                server.dispatch(self, 'PUT')
+
+            # pylint: disable=redefined-builtin
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = None
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    # pylint: disable=redefined-builtin
+    def __exit__(self, type, value, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def dispatch(self, handler, method):
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+
+        with self.lock:
+            self.requests.append((method, handler.path, dict(handler.headers), body))
+
+        status, headers, content = self.respond(method, handler.path, handler.headers, body)
+
+        handler.send_response(status)
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    # pylint: disable=no-self-use,unused-argument
+    def respond(self, method, path, headers, body):
+        return 404, {}, b''
+
+
+class FakeGCMServer(LocalHTTPServer):
+    '''
+    answers GCM multicast requests; registration ids in unregistered get a NotRegistered
+    error, those in canonical succeed but report the mapped canonical id
+    '''
+
+    def __init__(self, unregistered=(), canonical=None, errors=None):
+        super(FakeGCMServer, self).__init__()
+        self.unregistered = set(unregistered)
+        self.canonical = dict(canonical or {})
+        self.errors = dict(errors or {})
+        self.counter = 0
+
+    def respond(self, method, path, headers, body):
+        if method != 'POST':
+            return 405, {}, b''
+
+        payload = json.loads(body.decode('utf-8'))
+        results = []
+
+        for registration_id in payload.get('registration_ids') or ():
+            if registration_id in self.unregistered:
+                results.append({'error': 'NotRegistered'})
+            elif registration_id in self.errors:
+                results.append({'error': self.errors[registration_id]})
+            else:
+                self.counter += 1
+                result = {'message_id': '0:{}'.format(self.counter)}
+                if registration_id in self.canonical:
+                    result['registration_id'] = self.canonical[registration_id]
+                results.append(result)
+
+        response = {
+            'multicast_id': self.counter,
+            'success': sum(1 for result in results if 'message_id' in result),
+            'failure': sum(1 for result in results if 'error' in result),
+            'canonical_ids': sum(1 for result in results if 'registration_id' in result),
+            'results': results,
+        }
+
+        return 200, {'Content-Type': 'application/json'}, json.dumps(response).encode('utf-8')
+
+
+class FakeGravatarServer(LocalHTTPServer):
+    '''
+    serves avatars by email hash like Gravatar with d=404: hashes in avatars get
+    their content, all others a 404; pass base url + '/avatar/' to AvatarFetcher
+    '''
+
+    def __init__(self, avatars=None, latency=0):
+        super(FakeGravatarServer, self).__init__()
+        self.avatars = dict(avatars or {})
+        self.latency = latency
+
+    def respond(self, method, path, headers, body):
+        if method != 'GET':
+            return 405, {}, b''
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        gravatar = path.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+        content = self.avatars.get(gravatar)
+
+        if content is None:
+            return 404, {}, b''
+
+        return 200, {'Content-Type': 'image/jpeg'}, content
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+'''multicast delivery of GCM messages'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import logging
+import time
+
+# pylint: disable=redefined-builtin
+from builtins import range, zip
+
+import requests
+
+LOGGER = logging.getLogger(__name__)
+
+GCM_URL = 'https://gcm-http.googleapis.com/gcm/send'
+# maximum number of registration ids in one request
+MAX_REGISTRATION_IDS = 1000
+# errors after which a registration id must not be used again
+UNREGISTERED_ERRORS = frozenset(('NotRegistered', 'InvalidRegistration', 'MismatchSenderId'))
+
+
+class MulticastResult(object):
+    '''outcome of a multicast, per registration id'''
+
+    def __init__(self):
+        self.success = set()
+        self.canonical = {}
+        self.unregistered = set()
+        self.errors = {}
+
+    def update(self, registration_ids, results):
+        for registration_id, result in zip(registration_ids, results):
+            error = result.get('error')
+            if error in UNREGISTERED_ERRORS:
+                self.unregistered.add(registration_id)
+            elif error:
+                self.errors[registration_id] = error
+            else:
+                self.success.add(registration_id)
+                if result.get('registration_id'):
+                    self.canonical[registration_id] = result['registration_id']
+
+    def fail(self, registration_ids, error):
+        for registration_id in registration_ids:
+            self.errors[registration_id] = error
+
+    def __repr__(self):
+        return ('<MulticastResult success={} canonical={} unregistered={} errors={}>'
+                .format(len(self.success), len(self.canonical),
+                        len(self.unregistered), len(self.errors)))
+
+
+class GCMMulticast(object):
+    '''sends one message to many registration ids with as few JSON requests as possible'''
+
+    def __init__(self, api_key, url=None, timeout=10, session=None):
+        self.api_key = api_key
+        self.url = url or GCM_URL
+        self.timeout = timeout
+        self.session = session or requests.Session()
+
+    def send(self, registration_ids, data):
+        registration_ids = sorted(set(filter(None, registration_ids)))
+        result = MulticastResult()
+
+        for start in range(0, len(registration_ids), MAX_REGISTRATION_IDS):
+            batch = registration_ids[start:start + MAX_REGISTRATION_IDS]
+
+            stt = time.time()
+            try:
+                response = self.session.post(
+                    self.url,
+                    json={'registration_ids': batch, 'data': data},
+                    headers={'Authorization': 'key={}'.format(self.api_key)},
+                    timeout=self.timeout,
+                )
+                response.raise_for_status()
+                result.update(batch, response.json().get('results') or ())
+            except Exception as exc:
+                LOGGER.warning(exc)
+                result.fail(batch, str(exc))
+
+            LOGGER.info('sending GCM message to %d registration ids took %.3f seconds',
+                        len(batch), time.time() - stt)
+
+        return result
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+'''
+a cached, uniformly random sample of public image ids plus a per-player overlay
+of the player's own private images, for drawing random images without queries
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import logging
+
+from django.utils.crypto import random
+from google.appengine.api import memcache
+
+from .scheduler import schedule_image_pool
+
+LOGGER = logging.getLogger(__name__)
+
+POOL_KEY = 'image-pool-public'
+OVERLAY_KEY = 'image-pool-player-{}'
+# maximum number of public image ids held in the pool
+POOL_SIZE = 5000
+# the pool is rebuilt from the datastore at least this often
+POOL_TIMEOUT = 60 * 60 * 24
+# a stopgap pool is replaced by the background scan's sample within this time
+STOPGAP_TIMEOUT = 60 * 10
+OVERLAY_TIMEOUT = 60 * 60
+# attempts to write a concurrently changed pool before dropping it
+CAS_RETRIES = 3
+
+
+class ImagePool(object):
+    '''
+    the public pool is a reservoir sample of at most size ids together with the
+    number of public images it was drawn from; new public images join it by reservoir
+    sampling with compare and set, and it is rebuilt when it drops out of the cache.
+    Pool and overlays live in App Engine's memcache directly, which offers gets and cas.
+    '''
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+
+    # pylint: disable=no-self-use
+    def _images(self):
+        from .models import Image
+        return Image.objects
+
+    def _public(self):
+        return self._images().filter(is_available_publicly=True).values_list('pk', flat=True)
+
+    def public(self):
+        '''ids in the pool and the number of public images they represent'''
+
+        pool = memcache.get(POOL_KEY)
+        if pool is None:
+            pool = self.rebuild()
+        return pool['pks'], pool['count']
+
+    def rebuild(self):
+        '''
+        every public id if there are at most size of them, read with one keys-only
+        query; otherwise a stopgap window of the random order until the background
+        scan stores its sample
+        '''
+
+        public = self._public()
+        pks = list(public[:self.size + 1])
+
+        if len(pks) <= self.size:
+            pool = {'pks': pks, 'count': len(pks)}
+            memcache.set(POOL_KEY, pool, POOL_TIMEOUT)
+            LOGGER.info('rebuilt image pool with all %d public images', len(pks))
+            return pool
+
+        schedule_image_pool()
+
+        # not uniform, see random_slice, and there are at least this many public images
+        pool = {'pks': self._images().random_slice(self.size, public), 'count': len(pks)}
+        # unless the scan stored its sample already
+        memcache.add(POOL_KEY, pool, STOPGAP_TIMEOUT)
+        return pool
+
+    def scan(self):
+        '''
+        reservoir sample of size ids over a keys-only scan of all public images,
+        uniform and with their exact number; runs in the background
+        '''
+
+        pks = []
+        count = 0
+
+        for pk in self._public().iterator():
+            count += 1
+            if len(pks) < self.size:
+                pks.append(pk)
+            else:
+                index = random.randint(0, count - 1)
+                if index < self.size:
+                    pks[index] = pk
+
+        pool = {'pks': pks, 'count': count}
+        memcache.set(POOL_KEY, pool, POOL_TIMEOUT)
+        LOGGER.info('scanned image pool with %d of %d public images', len(pks), count)
+        return pool
+
+    def overlay(self, player_pk):
+        '''ids of the player's own images that aren't in the public pool'''
+
+        key = OVERLAY_KEY.format(player_pk)
+        pks = memcache.get(key)
+
+        if pks is None:
+            pks = list(self._images().filter(owner=player_pk, is_available_publicly=False)
+                       .values_list('pk', flat=True))
+            memcache.set(key, pks, OVERLAY_TIMEOUT)
+
+        return pks
+
+    def update(self, image, was_public=None, previous_owner=None):
+        '''record a created image or a change of its copyright or owner'''
+
+        if image.is_available_publicly != bool(was_public):
+            self._update_pool(image)
+
+        # overlays are small, drop them and let the next draw reload them
+        owners = {image.owner_id, previous_owner} - {None}
+        if owners:
+            memcache.delete_multi([OVERLAY_KEY.format(owner) for owner in owners])
+
+    def _update_pool(self, image):
+        # the client remembers the values read with gets for cas, so it is not shared
+        client = memcache.Client()
+
+        for _ in range(CAS_RETRIES):
+            pool = client.gets(POOL_KEY)
+            if pool is None:
+                return
+
+            pks = pool['pks']
+
+            if image.is_available_publicly:
+                # one more step of the reservoir sample
+                pool['count'] += 1
+                if len(pks) < self.size:
+                    pks.append(image.pk)
+                else:
+                    index = random.randint(0, pool['count'] - 1)
+                    if index < self.size:
+                        pks[index] = image.pk
+
+            else:
+                pool['count'] = max(pool['count'] - 1, 0)
+                if image.pk in pks:
+                    pks.remove(image.pk)
+
+            if client.cas(POOL_KEY, pool, POOL_TIMEOUT):
+                return
+
+        # too much contention: let the next draw rebuild the pool
+        LOGGER.warning('unable to update the image pool with image %s', image.pk)
+        client.delete(POOL_KEY)
+
+    def sample(self, size, player_pk=None):
+        '''
+        up to size ids drawn uniformly without replacement from the public images
+        and, if given, the player's own; public ids come from the pool sample
+        '''
+
+        overlay_key = OVERLAY_KEY.format(player_pk)
+        cached = memcache.get_multi([POOL_KEY, overlay_key] if player_pk else [POOL_KEY])
+
+        pool = cached.get(POOL_KEY) or self.rebuild()
+        public_pks, public_count = list(pool['pks']), pool['count']
+
+        overlay = cached.get(overlay_key) if player_pk else []
+        overlay = list(self.overlay(player_pk) if overlay is None else overlay)
+
+        # public images not drawn yet, of which the pool holds a uniform sample
+        public_left = max(public_count, len(public_pks))
+        result = []
+
+        while len(result) < size and (public_pks or overlay):
+            if overlay and (not public_pks or
+                            random.random() * (len(overlay) + public_left) < len(overlay)):
+                source = overlay
+            else:
+                source = public_pks
+                public_left -= 1
+
+            index = random.randrange(len(source))
+            source[index], source[-1] = source[-1], source[index]
+            result.append(source.pop())
+
+        return result
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+'''
+read image dimensions from the first bytes of JPEG, PNG, GIF and WebP files
+and render resized, re-encoded variants of images
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import hashlib
+import logging
+import struct
+
+from collections import OrderedDict, namedtuple
+from io import BytesIO
+
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 16 * 1024
+# give up on files whose dimensions aren't known after this many bytes,
+# JPEGs with large EXIF or ICC segments need the most
+MAX_HEADER_SIZE = 512 * 1024
+
+# JPEG start of frame markers, which carry the dimensions
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+ImageHeader = namedtuple('ImageHeader', ('format', 'width', 'height'))
+VariantSpec = namedtuple('VariantSpec', ('width', 'height', 'format', 'quality'))
+
+# variants generated for every image, they fit into the box and are never upscaled
+VARIANTS = OrderedDict((
+    ('thumbnail', VariantSpec(320, 320, 'jpeg', 80)),
+    ('screen', VariantSpec(1080, 1920, 'jpeg', 85)),
+    ('webp', VariantSpec(1080, 1920, 'webp', 80)),
+))
+
+UNKNOWN = ImageHeader(None, None, None)
+
+
+def _jpeg(data):
+    offset = 2
+
+    while offset + 4 <= len(data):
+        if data[offset:offset + 1] != b'\xff':
+            return UNKNOWN
+
+        marker = bytearray(data[offset + 1:offset + 2])[0]
+
+        if marker == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+
+        if marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > len(data):
+                break
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return ImageHeader('jpeg', width, height)
+
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        offset += 2 + length
+
+    return ImageHeader('jpeg', None, None)
+
+
+def _png(data):
+    if len(data) < 24:
+        return ImageHeader('png', None, None)
+
+    width, height = struct.unpack('>II', data[16:24])
+    return ImageHeader('png', width, height)
+
+
+def _gif(data):
+    if len(data) < 10:
+        return ImageHeader('gif', None, None)
+
+    width, height = struct.unpack('<HH', data[6:10])
+    return ImageHeader('gif', width, height)
+
+
+def _webp(data):
+    if len(data) < 30:
+        return ImageHeader('webp', None, None)
+
+    chunk = data[12:16]
+
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', data[26:30])
+        return ImageHeader('webp', width & 0x3FFF, height & 0x3FFF)
+
+    if chunk == b'VP8L':
+        bits = bytearray(data[21:25])
+        width = 1 + (((bits[1] & 0x3F) << 8) | bits[0])
+        height = 1 + (((bits[3] & 0xF) << 10) | (bits[2] << 2) | ((bits[1] & 0xC0) >> 6))
+        return ImageHeader('webp', width, height)
+
+    if chunk == b'VP8X':
+        bits = bytearray(data[24:30])
+        width = 1 + (bits[0] | bits[1] << 8 | bits[2] << 16)
+        height = 1 + (bits[3] | bits[4] << 8 | bits[5] << 16)
+        return ImageHeader('webp', width, height)
+
+    return UNKNOWN
+
+
+def probe_header(data):
+    '''
+    format, width and height of the image starting with the given bytes;
+    width and height are None if more bytes are needed, format is None
+    if the bytes don't start a supported image
+    '''
+
+    data = bytes(data)
+
+    if data[:3] == b'\xff\xd8\xff':
+        return _jpeg(data)
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return _png(data)
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return _gif(data)
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _webp(data)
+
+    return UNKNOWN
+
+
+class ImageProbe(object):
+    '''collects the leading chunks of an image until its dimensions are known'''
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE):
+        self.max_header_size = max_header_size
+        self.buffer = bytearray()
+        self.header = UNKNOWN
+        self.size = 0
+        self.done = False
+
+    @property
+    def format(self):
+        return self.header.format
+
+    @property
+    def width(self):
+        return self.header.width
+
+    @property
+    def height(self):
+        return self.header.height
+
+    def feed(self, chunk):
+        '''add the next chunk of the file, returns True once no more bytes are needed'''
+
+        self.size += len(chunk)
+
+        if self.done:
+            return True
+
+        self.buffer.extend(chunk)
+        self.header = probe_header(self.buffer)
+
+        if self.header.width or len(self.buffer) >= self.max_header_size:
+            self.done = True
+        elif self.header.format is None and len(self.buffer) >= 12:
+            # not a supported format, no point in looking further
+            self.done = True
+
+        if self.done:
+            self.buffer = bytearray()
+
+        return self.done
+
+
+def probe_file(file, chunk_size=CHUNK_SIZE, max_header_size=MAX_HEADER_SIZE):
+    '''
+    probe an open local file or upload from its current position, reading only
+    as many chunks as needed; the file is rewound to where it started
+    '''
+
+    probe = ImageProbe(max_header_size=max_header_size)
+
+    try:
+        position = file.tell()
+    except (AttributeError, IOError, ValueError):
+        position = None
+
+    try:
+        while not probe.done:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            probe.feed(chunk)
+    except Exception as exc:
+        LOGGER.warning(exc)
+    finally:
+        if position is not None:
+            file.seek(position)
+
+    return probe
+
+
+def fit(width, height, max_width, max_height):
+    '''dimensions scaled down to fit into the box, keeping the aspect ratio'''
+
+    if not width or not height:
+        return max_width, max_height
+
+    scale = min(max_width / width, max_height / height, 1)
+    return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+
+def _render_image_api(content, width, height, spec):
+    # pylint: disable=import-error
+    from google.appengine.api import images
+
+    encoding = images.WEBP if spec.format == 'webp' else images.JPEG
+    return images.resize(content, width=width, height=height,
+                         output_encoding=encoding, quality=spec.quality)
+
+
+def _render_pillow(content, width, height, spec):
+    # pylint: disable=import-error
+    from PIL import Image as PillowImage
+
+    image = PillowImage.open(BytesIO(content))
+    # LANCZOS is called ANTIALIAS up to Pillow 2.7 and in PIL 1.1.7
+    image.thumbnail((width, height), getattr(PillowImage, 'LANCZOS', PillowImage.ANTIALIAS))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    output = BytesIO()
+    image.save(output, spec.format.upper(), quality=spec.quality)
+    return output.getvalue()
+
+
+def render_variant(content, spec, width=None, height=None):
+    '''
+    the image resized to fit the spec's box and encoded in its format, through
+    the App Engine images API or Pillow where that isn't available; returns
+    the encoded bytes and their header
+    '''
+
+    if not (width and height):
+        header = probe_header(content[:MAX_HEADER_SIZE])
+        width, height = header.width, header.height
+
+    width, height = fit(width, height, spec.width, spec.height)
+
+    try:
+        result = _render_image_api(content, width, height, spec)
+    except ImportError:
+        result = _render_pillow(content, width, height, spec)
+
+    return result, probe_header(result[:MAX_HEADER_SIZE])
+
+
+def scan_file(file, chunk_size=CHUNK_SIZE, max_header_size=MAX_HEADER_SIZE):
+    '''
+    probe the dimensions and hash the content of a local upload in one pass
+    from its current position; returns the probe and the SHA-256 hex digest,
+    the file is rewound to where it started
+    '''
+
+    probe = ImageProbe(max_header_size=max_header_size)
+    sha = hashlib.sha256()
+
+    try:
+        position = file.tell()
+    except (AttributeError, IOError, ValueError):
+        position = None
+
+    try:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            probe.feed(chunk)
+            sha.update(chunk)
+    finally:
+        if position is not None:
+            file.seek(position)
+
+    return probe, sha.hexdigest()
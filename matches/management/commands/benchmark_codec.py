@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+'''benchmark decoding and encoding of a match's rounds and details'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import timeit
+
+# pylint: disable=redefined-builtin
+from builtins import range, str
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import (
+    Match, MatchDetails, MatchDetailsSerializer,
+    Round, RoundDetails, RoundDetailsSerializer, RoundSerializer)
+
+
+def largest_match_data(players=Match.MAXIMUM_PLAYER, rounds=None):
+    '''stored JSON of a finished match with every field populated'''
+
+    rounds = rounds or players
+    now = timezone.now()
+    player_pks = [5629499534213120 + i for i in range(players)]
+
+    details = {str(pk): MatchDetails(
+        player=pk,
+        is_inviting_player=i == 0,
+        invitation_status=MatchDetails.ACCEPTED,
+        date_responded=now,
+        score=3 * rounds,
+        notification_sent=now,
+    ).to_data() for i, pk in enumerate(player_pks)}
+
+    round_data = []
+    for number in range(1, rounds + 1):
+        storyteller = player_pks[(number - 1) % players]
+        round_details = {str(pk): RoundDetails(
+            player=pk,
+            is_storyteller=pk == storyteller,
+            image=6192449487634432 + number * players + i,
+            score=3,
+            vote=None if pk == storyteller else 6192449487634432 + number * players,
+            vote_player=None if pk == storyteller else storyteller,
+            notification_image_sent=now,
+            notification_vote_sent=now,
+            notification_finished_sent=now,
+        ).to_data() for i, pk in enumerate(player_pks)}
+        round_data.append(Round(
+            number=number,
+            storyteller=storyteller,
+            details=round_details,
+            status=Round.FINISHED,
+            story='a story for round {}'.format(number),
+            deadline_story=now + timedelta(hours=number),
+            deadline_others=now + timedelta(hours=number + 1),
+            deadline_votes=now + timedelta(hours=number + 2),
+        ).to_data())
+
+    return details, round_data
+
+
+def decode_serializers(details, rounds):
+    '''the previous decoding: full validation of every record'''
+
+    result = {}
+    for player_pk, data in details.items():
+        serializer = MatchDetailsSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        result[int(player_pk)] = serializer.save()
+
+    rounds_list = []
+    for data in rounds:
+        serializer = RoundSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        round_ = serializer.save()
+        round_details = {}
+        for player_pk, details_data in round_.details.items():
+            details_serializer = RoundDetailsSerializer(data=details_data)
+            details_serializer.is_valid(raise_exception=True)
+            round_details[int(player_pk)] = details_serializer.save()
+        round_._details_dict = round_details
+        rounds_list.append(round_)
+
+    return result, rounds_list
+
+
+def encode_serializers(details, rounds):
+    '''the previous encoding through the serializers'''
+
+    details_data = {player_pk: MatchDetailsSerializer(instance=obj).data
+                    for player_pk, obj in details.items()}
+    for round_ in rounds:
+        round_.details = {player_pk: RoundDetailsSerializer(instance=obj).data
+                          for player_pk, obj in round_._details_dict.items()}
+    return details_data, RoundSerializer(instance=rounds, many=True).data
+
+
+def decode_codec(details, rounds):
+    result = {int(player_pk): MatchDetails.from_data(data) for player_pk, data in details.items()}
+    rounds_list = [Round.from_data(data) for data in rounds]
+    for round_ in rounds_list:
+        round_.details_dict  # pylint: disable=pointless-statement
+    return result, rounds_list
+
+
+def encode_codec(details, rounds):
+    return ({str(player_pk): obj.to_data() for player_pk, obj in details.items()},
+            [round_.to_data() for round_ in rounds])
+
+
+class Command(BaseCommand):
+    help = 'Benchmark decoding and encoding of match rounds and details'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=Match.MAXIMUM_PLAYER)
+        parser.add_argument('--rounds', type=int, default=None)
+        parser.add_argument('--number', type=int, default=20)
+
+    def handle(self, *args, **options):
+        details, rounds = largest_match_data(options['players'], options['rounds'])
+        number = options['number']
+
+        self.stdout.write('match with {} players and {} rounds, {} repetitions'
+                          .format(options['players'], len(rounds), number))
+
+        for name, decode, encode in (('serializers', decode_serializers, encode_serializers),
+                                     ('codec', decode_codec, encode_codec)):
+            decode_time = timeit.timeit(lambda: decode(details, rounds), number=number) / number
+            decoded = decode(details, rounds)
+            encode_time = timeit.timeit(lambda: encode(*decoded), number=number) / number
+            self.stdout.write('{:<12} decode: {:8.3f} ms  encode: {:8.3f} ms'
+                              .format(name, decode_time * 1000, encode_time * 1000))
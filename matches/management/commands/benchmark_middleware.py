@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+'''benchmark the middleware overhead of API calls with the full stack and the fast path'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import time
+
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from google.appengine.api import apiproxy_stub_map
+from rest_framework_jwt.settings import api_settings
+
+from ...models import Player
+from .benchmark_rpcs import RpcCounter
+
+
+def full_stack():
+    '''the browser middleware spliced in place, i.e. run for every request like before'''
+
+    result = []
+    for path in settings.MIDDLEWARE_CLASSES:
+        if path == 'matches.middleware.BrowserMiddleware':
+            result.extend(settings.BROWSER_MIDDLEWARE_CLASSES)
+        else:
+            result.append(path)
+    return tuple(result)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark time and RPCs per API call with the full middleware stack and the fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('player', type=int)
+        parser.add_argument('--path', default='/matches/')
+        parser.add_argument('--number', type=int, default=50)
+
+    def handle(self, *args, **options):
+        # pylint: disable=no-member
+        player = Player.objects.get(pk=options['player'])
+        token = api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(player.user))
+        header = '{} {}'.format(api_settings.JWT_AUTH_HEADER_PREFIX, token)
+        path, number = options['path'], options['number']
+
+        counter = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark-middleware', counter)
+
+        self.stdout.write('GET {}, {} requests'.format(path, number))
+        self.stdout.write('{:<10} {:>10} {:>10} {:>10}'.format(
+            'stack', 'ms', 'datastore', 'memcache'))
+
+        for name, middleware in (('full', full_stack()),
+                                 ('fast path', tuple(settings.MIDDLEWARE_CLASSES))):
+            with override_settings(MIDDLEWARE_CLASSES=middleware):
+                # a new client loads the middleware from the overridden settings
+                client = Client(HTTP_AUTHORIZATION=header)
+                client.get(path)
+
+                totals = Counter()
+                stt = time.time()
+                for _ in range(number):
+                    with counter.count() as calls:
+                        response = client.get(path)
+                    if response.status_code >= 400:
+                        raise CommandError('{} returned {}'.format(path, response.status_code))
+                    totals.update(calls)
+                seconds = time.time() - stt
+
+            self.stdout.write('{:<10} {:>10.3f} {:>10.1f} {:>10.1f}'.format(
+                name, seconds * 1000 / number,
+                totals['datastore_v3'] / number, totals['memcache'] / number))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+'''benchmark reading image dimensions from header bytes against decoding the image'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import os
+import timeit
+
+from io import BytesIO
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...image_utils import probe_file
+
+FORMATS = (
+    ('jpeg', 'JPEG', {'quality': 90}),
+    ('png', 'PNG', {}),
+    ('webp', 'WEBP', {'quality': 80}),
+    ('webp-lossless', 'WEBP', {'lossless': True}),
+)
+
+
+def fixtures(width, height):
+    '''noisy test images in every format, generated with Pillow'''
+
+    try:
+        # pylint: disable=import-error
+        from PIL import Image as PillowImage
+    except ImportError:
+        raise CommandError('Pillow is required to generate the fixtures')
+
+    image = PillowImage.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+
+    result = []
+    for name, pillow_format, options in FORMATS:
+        output = BytesIO()
+        try:
+            image.save(output, pillow_format, **options)
+        except (IOError, KeyError) as exc:
+            # Pillow built without support for the format
+            result.append((name, None, exc))
+            continue
+        result.append((name, output.getvalue(), None))
+    return result
+
+
+def decode_pillow(content):
+    '''the previous way: decode the whole image to learn its size'''
+
+    # pylint: disable=import-error
+    from PIL import Image as PillowImage
+
+    image = PillowImage.open(BytesIO(content))
+    image.load()
+    return image.size
+
+
+class CountingFile(BytesIO):
+    bytes_read = 0
+
+    def read(self, *args):
+        data = BytesIO.read(self, *args)
+        self.bytes_read += len(data)
+        return data
+
+
+class Command(BaseCommand):
+    help = 'Benchmark header-only dimension probing over JPEG, PNG and WebP images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--width', type=int, default=1920)
+        parser.add_argument('--height', type=int, default=1080)
+        parser.add_argument('--number', type=int, default=20)
+
+    def handle(self, *args, **options):
+        width, height, number = options['width'], options['height'], options['number']
+
+        self.stdout.write('{}x{} images, {} repetitions'.format(width, height, number))
+
+        for name, content, error in fixtures(width, height):
+            if content is None:
+                self.stdout.write('{:<14} skipped: {}'.format(name, error))
+                continue
+
+            counting = CountingFile(content)
+            probe = probe_file(counting)
+            if (probe.width, probe.height) != (width, height):
+                raise CommandError('probing {} returned {}x{}'
+                                   .format(name, probe.width, probe.height))
+
+            probe_time = timeit.timeit(lambda: probe_file(BytesIO(content)),
+                                       number=number) / number
+            decode_time = timeit.timeit(lambda: decode_pillow(content), number=number) / number
+
+            self.stdout.write(
+                '{:<14} size: {:>9} B  header read: {:>7} B  probe: {:8.3f} ms  '
+                'decode: {:8.3f} ms'.format(name, len(content), counting.bytes_read,
+                                           probe_time * 1000, decode_time * 1000))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+'''benchmark drawing random images through the paginator against the image pool'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils.crypto import random
+from djangae.contrib.pagination import Paginator
+
+from ...models import IMAGE_POOL, Image, Player
+
+
+def random_paginator(size, player=None):
+    '''the previous way: shuffle the pages of a random_order query and walk them'''
+
+    query = Q(is_available_publicly=True)
+    if player:
+        query |= Q(owner=player)
+
+    # pylint: disable=no-member
+    images = Image.objects.order_by('random_order').filter(query)
+    images = images.reverse() if random.random() < .5 else images
+
+    paginator = Paginator(images, size * 2, readahead=100)
+    paginator.page(1)
+    page_range = list(paginator.page_range)
+    random.shuffle(page_range)
+
+    image_list = []
+    for page_num in page_range:
+        image_list.extend(paginator.page(page_num))
+        if len(image_list) >= size:
+            break
+
+    random.shuffle(image_list)
+    return image_list[:size]
+
+
+def random_pool(size, player=None):
+    pks = IMAGE_POOL.sample(size, player.pk if player else None)
+    # pylint: disable=no-member
+    images = Image.objects.in_bulk(pks)
+    return [images[pk] for pk in pks if pk in images]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark random image selection with the paginator and with the image pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=5)
+        parser.add_argument('--number', type=int, default=20)
+        parser.add_argument('--player', type=int, default=None)
+
+    def handle(self, *args, **options):
+        size, number = options['size'], options['number']
+        # pylint: disable=no-member
+        player = Player.objects.get(pk=options['player']) if options['player'] else None
+
+        # build the pool outside of the measurement, like a warm cache in production
+        IMAGE_POOL.sample(size, player.pk if player else None)
+
+        self.stdout.write('{} random images, {} repetitions'.format(size, number))
+
+        for name, func in (('paginator', random_paginator), ('pool', random_pool)):
+            seconds = timeit.timeit(lambda: func(size, player), number=number) / number
+            self.stdout.write('{:<10} {:8.3f} ms'.format(name, seconds * 1000))
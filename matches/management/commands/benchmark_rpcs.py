@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+'''count the datastore and memcache RPCs per endpoint with the stateless and the full JWT user'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+from collections import Counter
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from google.appengine.api import apiproxy_stub_map
+from rest_framework.test import APIClient
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings
+
+from ...authentication import StatelessJSONWebTokenAuthentication
+from ...models import Match, Player
+
+
+class RpcCounter(object):
+    '''pre-call hook counting the API calls per service while enabled'''
+
+    def __init__(self):
+        self.calls = Counter()
+        self.enabled = False
+
+    # pylint: disable=unused-argument
+    def __call__(self, service, call, request, response):
+        if self.enabled:
+            self.calls[service] += 1
+
+    @contextmanager
+    def count(self):
+        self.calls.clear()
+        self.enabled = True
+        try:
+            yield self.calls
+        finally:
+            self.enabled = False
+
+
+@contextmanager
+def full_user():
+    '''authenticate like before: load the user for every token, the player on first use'''
+
+    stateless = StatelessJSONWebTokenAuthentication.authenticate_credentials
+    StatelessJSONWebTokenAuthentication.authenticate_credentials = (
+        JSONWebTokenAuthentication.authenticate_credentials)
+    try:
+        yield
+    finally:
+        StatelessJSONWebTokenAuthentication.authenticate_credentials = stateless
+
+
+@contextmanager
+def stateless_user():
+    '''the configured authentication, the principal comes from the token claims'''
+
+    yield
+
+
+MODES = (('full', full_user), ('stateless', stateless_user))
+
+
+class Command(BaseCommand):
+    help = 'Count datastore and memcache RPCs per endpoint with the stateless and the full user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('player', type=int)
+        parser.add_argument('--match', type=int, default=None)
+        parser.add_argument('--number', type=int, default=5)
+
+    def handle(self, *args, **options):
+        # pylint: disable=no-member
+        player = Player.objects.get(pk=options['player'])
+        match = (Match.objects.get(pk=options['match']) if options['match']
+                 else Match.objects.for_player(player.pk).first())
+        if match is None:
+            raise CommandError('player {} has no matches'.format(player.pk))
+
+        payload = api_settings.JWT_PAYLOAD_HANDLER(player.user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='JWT {}'.format(
+            api_settings.JWT_ENCODE_HANDLER(payload)))
+
+        endpoints = (
+            ('matches', '/matches/'),
+            ('match', '/matches/{}/'.format(match.pk)),
+            ('chat', '/matches/{}/chat/'.format(match.pk)),
+            ('players', '/matches/{}/players/'.format(match.pk)),
+        )
+
+        counter = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark-rpcs', counter)
+
+        self.stdout.write('average RPCs over {} requests per endpoint'.format(options['number']))
+        self.stdout.write('{:<10} {:<10} {:>10} {:>10}'.format(
+            'endpoint', 'user', 'datastore', 'memcache'))
+
+        for name, path in endpoints:
+            for mode, context in MODES:
+                totals = Counter()
+                with context():
+                    for _ in range(options['number']):
+                        with counter.count() as calls:
+                            response = client.get(path)
+                        if response.status_code >= 400:
+                            raise CommandError('{} returned {}'.format(path, response.status_code))
+                        totals.update(calls)
+
+                self.stdout.write('{:<10} {:<10} {:>10.1f} {:>10.1f}'.format(
+                    name, mode,
+                    totals['datastore_v3'] / options['number'],
+                    totals['memcache'] / options['number']))
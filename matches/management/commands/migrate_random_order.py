@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+'''give every image a fixed random_order once, so nothing needs to reshuffle them later'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+from django.core.management.base import BaseCommand
+
+from ...models import Image
+from ...utils import bulk_save, random_integer
+
+
+class Command(BaseCommand):
+    help = 'Assign a fixed random_order to images that have none, or to all with --all'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='assign new random keys to every image')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        checked = written = 0
+        last_pk = None
+
+        while True:
+            # pylint: disable=no-member
+            images = Image.objects.order_by('pk')
+            if last_pk is not None:
+                images = images.filter(pk__gt=last_pk)
+            images = list(images[:batch_size])
+
+            if not images:
+                break
+
+            to_write = [image for image in images
+                        if options['all'] or image.random_order is None]
+            for image in to_write:
+                image.random_order = random_integer()
+
+            # batched raw puts, Image.save and its pool updates are skipped
+            written += bulk_save(to_write)
+            checked += len(images)
+            last_pk = images[-1].pk
+
+            self.stdout.write('checked {} images, wrote {}'.format(checked, written))
+
+        self.stdout.write('done: checked {} images, wrote {}'.format(checked, written))
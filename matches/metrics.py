@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+'''counters shared between instances through the cache'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import logging
+
+from django.core.cache import cache
+
+LOGGER = logging.getLogger(__name__)
+
+# counters are reset after this many seconds without being written
+COUNTERS_TIMEOUT = 60 * 60 * 24 * 7
+
+
+class Counters(object):
+    '''named counters under a common prefix, incremented atomically in memcache'''
+
+    def __init__(self, prefix, names=()):
+        self.prefix = prefix
+        self.names = tuple(names)
+
+    def key(self, name):
+        return 'counter-{}-{}'.format(self.prefix, name)
+
+    def incr(self, name, delta=1):
+        key = self.key(name)
+        try:
+            try:
+                return cache.incr(key, delta)
+            except ValueError:
+                # not in the cache yet, unless another instance just added it
+                if cache.add(key, delta, COUNTERS_TIMEOUT):
+                    return delta
+                return cache.incr(key, delta)
+        except Exception as exc:
+            LOGGER.warning('unable to count %s', key)
+            LOGGER.warning(exc)
+            return None
+
+    def get(self, names=None):
+        names = tuple(names or self.names)
+        values = cache.get_many([self.key(name) for name in names])
+        return {name: values.get(self.key(name)) or 0 for name in names}
+
+    def reset(self, names=None):
+        cache.delete_many([self.key(name) for name in (names or self.names)])
+
+    def ratio(self, hits='hits', misses='misses'):
+        '''counters with the share of hits among hits and misses'''
+
+        values = self.get(set(self.names) | {hits, misses})
+        total = values[hits] + values[misses]
+        values['hit_rate'] = values[hits] / total if total else None
+        return values
@@ -2,41 +2,148 @@
 
 '''middleware'''
 
-# Orignal version taken from http://www.djangosnippets.org/snippets/186/
-# Original author: udfalkso
-# Modified by: Shwagroo Team and Gun.io
-# See https://gun.io/blog/fast-as-fuck-django-part-1-using-a-profiler/
-# Modified to use cProfile: Markus Shepherd
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
 
-import cProfile
 import logging
-import pstats
-from io import StringIO
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.urlresolvers import Resolver404, resolve
+from django.utils.module_loading import import_string
+from rest_framework_jwt.settings import api_settings
+
+from .authentication import UPGRADE_HEADER
+from .profiling import PROFILER
+
+
+def route_name(request):
+    '''the URL name of the request's view, Django falls back to its dotted path'''
+
+    resolver_match = getattr(request, 'resolver_match', None)
+    return resolver_match.view_name if resolver_match else 'unresolved'
 
 
 class ProfileMiddleware(object):
-    logger = logging.getLogger(__name__ + '.ProfileMiddleware')
-    prof = None
+    '''
+    profiles a sampled share of requests (settings.PROFILE_SAMPLE_RATE) per route, see
+    matches.profiling; with DEBUG, requests with ?prof are always profiled
+    '''
 
+    # pylint: disable=no-self-use
     def process_request(self, request):
-        if 'prof' in request.GET:
-            self.prof = cProfile.Profile()
-            self.prof.enable()
+        PROFILER.start(force=settings.DEBUG and 'prof' in request.GET)
+
+    def process_response(self, request, response):
+        PROFILER.stop('{} {}'.format(request.method, route_name(request)))
+        return response
 
+
+class JWTUpgradeMiddleware(object):
+    '''hand the token issued by CachedBasicAuthentication to the client in a response header'''
+
+    # pylint: disable=no-self-use
     def process_response(self, request, response):
-        if 'prof' in request.GET:
-            self.prof.disable()
+        token = getattr(request, 'jwt_upgrade', None)
+        if token:
+            response[UPGRADE_HEADER] = token
+        return response
+
+
+class BrowserMiddleware(object):
+    '''
+    runs settings.BROWSER_MIDDLEWARE_CLASSES (sessions, CSRF, messages, CSP, AppStats)
+    like Django would, except for requests to the API views in matches.urls that carry
+    a token: those never use a session, so they skip its datastore reads and writes
+    '''
+
+    logger = logging.getLogger(__name__ + '.BrowserMiddleware')
+
+    def __init__(self, classes=None):
+        self.request_middleware = []
+        self.view_middleware = []
+        self.template_response_middleware = []
+        self.response_middleware = []
+        self.exception_middleware = []
+
+        for path in (settings.BROWSER_MIDDLEWARE_CLASSES if classes is None else classes):
+            try:
+                instance = import_string(path)()
+            except MiddlewareNotUsed:
+                continue
 
-            self.logger.debug(request)
+            if hasattr(instance, 'process_request'):
+                self.request_middleware.append(instance.process_request)
+            if hasattr(instance, 'process_view'):
+                self.view_middleware.append(instance.process_view)
+            if hasattr(instance, 'process_template_response'):
+                self.template_response_middleware.insert(0, instance.process_template_response)
+            if hasattr(instance, 'process_response'):
+                self.response_middleware.insert(0, instance.process_response)
+            if hasattr(instance, 'process_exception'):
+                self.exception_middleware.insert(0, instance.process_exception)
 
-            stream = StringIO.StringIO()
-            stats = pstats.Stats(self.prof, stream=stream).sort_stats('cumulative')
-            stats.print_stats(.1, 20)
-            self.logger.debug(stream.getvalue())
+    @staticmethod
+    def is_api_request(request):
+        '''token authenticated request to a REST framework view of this app'''
 
-            stream = StringIO.StringIO()
-            stats = pstats.Stats(self.prof, stream=stream).sort_stats('tottime')
-            stats.print_stats(.1, 20)
-            self.logger.debug(stream.getvalue())
+        prefix = '{} '.format(api_settings.JWT_AUTH_HEADER_PREFIX)
+        if not request.META.get('HTTP_AUTHORIZATION', '').startswith(prefix):
+            return False
+
+        try:
+            func = resolve(request.path_info).func
+        except Resolver404:
+            return False
+
+        return (getattr(func, 'cls', None) is not None
+                and func.__module__.startswith('matches.'))
+
+    def _skip(self, request):
+        return getattr(request, 'api_fast_path', False)
+
+    def process_request(self, request):
+        request.api_fast_path = self.is_api_request(request)
+        if request.api_fast_path:
+            return None
+
+        for method in self.request_middleware:
+            response = method(request)
+            if response is not None:
+                return response
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self._skip(request):
+            return None
+
+        for method in self.view_middleware:
+            response = method(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+        return None
+
+    def process_template_response(self, request, response):
+        if self._skip(request):
+            return response
+
+        for method in self.template_response_middleware:
+            response = method(request, response)
+        return response
+
+    def process_exception(self, request, exception):
+        if self._skip(request):
+            return None
+
+        for method in self.exception_middleware:
+            response = method(request, exception)
+            if response is not None:
+                return response
+        return None
+
+    def process_response(self, request, response):
+        if self._skip(request):
+            return response
 
+        for method in self.response_middleware:
+            response = method(request, response)
         return response
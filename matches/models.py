@@ -4,43 +4,125 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
 
-import hashlib
 import logging
+import os.path
 import time
 
 # pylint: disable=redefined-builtin
-from builtins import int, map, range, str
+from builtins import int, map, range, str, zip
 from collections import defaultdict
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
 from datetime import datetime, timedelta
 from io import BytesIO
 
-import requests
-
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
 from django.core.files.images import ImageFile
 from django.db import models
 from django.utils import timezone
 from django.utils.crypto import random
 from djangae import fields, storage
+from djangae.db import transaction
 from djangae.contrib.gauth_datastore.models import GaeDatastoreUser
 from djangae.contrib.pagination import paginated_model
-from djangae.db.consistency import ensure_instance_consistent
 from future.utils import python_2_unicode_compatible
-from gcm import GCM
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from six import iteritems, itervalues
 
+from .avatars import AvatarFetcher, content_digest, email_hash
+from .gcm_utils import GCMMulticast
+from .image_pool import ImagePool
+from .image_utils import VARIANTS, probe_file, render_variant, scan_file
+from .metrics import Counters
+from .profiles import PlayerProfiles
 from .pubsub_utils import PubSubSender
-from .utils import calculate_id, clear_list, find_current_round, random_integer
-
-GCM_SENDER = GCM(settings.GCM_API_KEY, debug=settings.DEBUG)
+from .scheduler import (
+    deadline_token, schedule_avatar, schedule_match,
+    schedule_notifications_drain, schedule_variants)
+from .uploads import MAX_UPLOAD_SIZE, get_upload_storage
+from .utils import (
+    bulk_save, calculate_id, chunks, clear_list, find_current_round,
+    format_datetime, parse_datetime, random_integer, run_in_pool)
+
+AVATAR_FETCHER = AvatarFetcher(settings.GRAVATAR_URL)
+GCM_SENDER = GCMMulticast(settings.GCM_API_KEY, url=settings.GCM_URL)
+IMAGE_DEDUPE = Counters('image-dedupe', ('hits', 'misses', 'deleted'))
+IMAGE_POOL = ImagePool()
 LOGGER = logging.getLogger(__name__)
+PLAYER_PROFILES = PlayerProfiles()
 PUBSUB_SENDER = PubSubSender()
 STORAGE = storage.CloudStorage(bucket='diris-app.appspot.com', google_acl='public-read')
+# seconds one run may take to create an image's variants before another may start
+VARIANTS_LOCK_TIMEOUT = 5 * 60
+
+
+class CompactRecord(object):
+    '''
+    base class for the records stored inside a match's JSON fields; decodes the
+    stored data straight into objects and encodes them back without running the
+    serializers (those validate at the API boundary only); records keep track of
+    the fields that changed since they were decoded, new records are always dirty
+    '''
+
+    __slots__ = ('_changed',)
+
+    FIELDS = ()
+    DATETIME_FIELDS = frozenset()
+    DEFAULTS = {}
+    PARENT = None
+
+    @classmethod
+    def from_data(cls, data, parent=None):
+        obj = cls.__new__(cls)
+
+        for field in cls.FIELDS:
+            value = data.get(field)
+            if value is None:
+                value = cls.DEFAULTS.get(field)
+            elif field in cls.DATETIME_FIELDS:
+                value = parse_datetime(value)
+            setattr(obj, field, value)
+
+        if cls.PARENT:
+            setattr(obj, cls.PARENT, parent)
+
+        obj._changed = set()
+
+        return obj
 
+    def __setattr__(self, name, value):
+        changed = getattr(self, '_changed', None)
+        if (changed is not None and name in self.FIELDS
+                and getattr(self, name, None) != value):
+            changed.add(name)
+        super(CompactRecord, self).__setattr__(name, value)
 
-class MatchDetails(object):
+    @property
+    def changed_fields(self):
+        '''names of the fields changed since decoding, None for new records'''
+
+        return getattr(self, '_changed', None)
+
+    @property
+    def is_dirty(self):
+        changed = self.changed_fields
+        return changed is None or bool(changed)
+
+    def mark_clean(self):
+        self._changed = set()
+
+    def to_data(self):
+        return {field: (format_datetime(getattr(self, field))
+                        if field in self.DATETIME_FIELDS else getattr(self, field))
+                for field in self.FIELDS}
+
+
+class MatchDetails(CompactRecord):
     INVITED = 'i'
     ACCEPTED = 'a'
     DECLINED = 'd'
@@ -50,6 +132,14 @@ class MatchDetails(object):
         (DECLINED, 'declined'),
     )
 
+    FIELDS = ('player', 'is_inviting_player', 'date_invited', 'invitation_status',
+              'date_responded', 'score', 'notification_sent')
+    DATETIME_FIELDS = frozenset(('date_invited', 'date_responded', 'notification_sent'))
+    DEFAULTS = {'is_inviting_player': False, 'invitation_status': INVITED, 'score': 0}
+    PARENT = 'match'
+
+    __slots__ = FIELDS + (PARENT,)
+
     def __init__(self, player, match=None, is_inviting_player=False, date_invited=None,
                  invitation_status=INVITED, date_responded=None, score=0, notification_sent=None):
         self.match = match
@@ -81,7 +171,16 @@ class MatchDetailsSerializer(serializers.Serializer):
         return MatchDetails(**validated_data)
 
 
-class RoundDetails(object):
+class RoundDetails(CompactRecord):
+    FIELDS = ('player', 'is_storyteller', 'image', 'score', 'vote', 'vote_player',
+              'notification_image_sent', 'notification_vote_sent', 'notification_finished_sent')
+    DATETIME_FIELDS = frozenset(('notification_image_sent', 'notification_vote_sent',
+                                 'notification_finished_sent'))
+    DEFAULTS = {'is_storyteller': False, 'score': 0}
+    PARENT = 'match_round'
+
+    __slots__ = FIELDS + (PARENT,)
+
     def __init__(self, player, match_round=None, is_storyteller=False, image=None,
                  score=0, vote=None, vote_player=None, notification_image_sent=None,
                  notification_vote_sent=None, notification_finished_sent=None):
@@ -126,7 +225,7 @@ class RoundDetailsSerializer(serializers.Serializer):
         return RoundDetails(**validated_data)
 
 
-class Round(object):
+class Round(CompactRecord):
     WAITING = 'w'
     SUBMIT_STORY = 's'
     SUBMIT_OTHERS = 'o'
@@ -159,6 +258,14 @@ class Round(object):
     NO_STORY_SCORE = 3
     NO_STORY_STORYTELLER_SCORE = 0
 
+    FIELDS = ('number', 'storyteller', 'is_current_round', 'status', 'story',
+              'deadline_story', 'deadline_others', 'deadline_votes')
+    DATETIME_FIELDS = frozenset(('deadline_story', 'deadline_others', 'deadline_votes'))
+    DEFAULTS = {'is_current_round': False, 'status': WAITING}
+    PARENT = 'match'
+
+    __slots__ = FIELDS + (PARENT, 'details', '_details_dict')
+
     def __init__(self, number, storyteller, details, match=None,
                  is_current_round=False, status=WAITING, story=None,
                  deadline_story=None, deadline_others=None, deadline_votes=None):
@@ -174,20 +281,57 @@ class Round(object):
         self.deadline_votes = deadline_votes
         self._details_dict = None
 
+    @classmethod
+    def from_data(cls, data, parent=None):
+        obj = super(Round, cls).from_data(data, parent=parent)
+        obj.details = data.get('details') or {}
+        obj._details_dict = None
+        return obj
+
+    def to_data(self):
+        data = super(Round, self).to_data()
+
+        if self._details_dict is None:
+            data['details'] = self.details
+            return data
+
+        details = dict(self.details)
+        details.update((str(player_pk), round_details.to_data())
+                       for player_pk, round_details in iteritems(self._details_dict)
+                       if round_details.is_dirty)
+        data['details'] = details
+        return data
+
+    @property
+    def is_dirty(self):
+        return (super(Round, self).is_dirty
+                or (self._details_dict is not None
+                    and any(details.is_dirty for details in itervalues(self._details_dict))))
+
+    def mark_clean(self):
+        super(Round, self).mark_clean()
+        for details in itervalues(self._details_dict or {}):
+            details.mark_clean()
+
+    @property
+    def details_decoded(self):
+        return self._details_dict is not None
+
     @property
     def details_dict(self):
         if self._details_dict is not None:
             return self._details_dict
 
-        result = {}
-        for player_pk, data in iteritems(self.details):
-            serializer = RoundDetailsSerializer(data=data)
-            serializer.is_valid(raise_exception=True)
-            result[int(player_pk)] = serializer.save(match_round=self)
-
-        self._details_dict = result
+        self._details_dict = {int(player_pk): RoundDetails.from_data(data, parent=self)
+                              for player_pk, data in iteritems(self.details)}
         return self._details_dict
 
+    def image_pks(self, exclude_player=None):
+        '''pks of the images submitted in this round, optionally but the given player's'''
+
+        return {details.image for details in itervalues(self.details_dict)
+                if details.image and details.player != exclude_player}
+
     def submit_image(self, player_pk, image_pk, story=None, match=None):
         if not (player_pk and image_pk and Image.objects.filter(pk=image_pk).exists()):
             raise ValueError('player and image are required')
@@ -196,6 +340,10 @@ class Round(object):
 
         details = self.details_dict[player_pk]
 
+        # votes identify submissions by image, so shared duplicates must not meet in a round
+        if image_pk in self.image_pks(exclude_player=player_pk):
+            raise ValueError('image already submitted in this round')
+
         if details.is_storyteller:
             if self.status != Round.SUBMIT_STORY:
                 raise ValueError('not ready for submission')
@@ -257,6 +405,11 @@ class Round(object):
         details.vote_player = vote_player
 
     def check_status(self, match=None, prev_round=None):
+        if self.status == Round.FINISHED:
+            # finished is terminal, so there is no need to look at the details again
+            self.is_current_round = False
+            return
+
         if (all(details.vote for player_pk, details in iteritems(self.details_dict)
                 if player_pk != self.storyteller)
                 or (self.deadline_votes and timezone.now() > self.deadline_votes)):
@@ -287,6 +440,10 @@ class Round(object):
 
         self.is_current_round = self.status not in (Round.FINISHED, Round.WAITING)
 
+        if self.status == Round.FINISHED:
+            # finished rounds won't be decoded again, so store their scores right away
+            self.score()
+
     def score(self):
         scores = defaultdict(int)
 
@@ -330,9 +487,15 @@ class Round(object):
 
         return scores
 
-    def send_notifications(self, match=None):
+    def send_notifications(self, match=None, profiles=None):
+        '''
+        notifications due in this round; the match enqueues them in the outbox and
+        passes its players' profiles, prefetched in one batch
+        '''
+
         match = match or self.match
         match_pk = match.pk if match else None
+        notifications = []
 
         if (self.status == Round.SUBMIT_STORY
                 and not self.details_dict[self.storyteller].notification_image_sent):
@@ -342,18 +505,16 @@ class Round(object):
                 'title': 'Tell your story!',
                 'message': 'A new round has started - tell us your story',
             }
-            response = PUBSUB_SENDER.send_message(data=data)
-
-            if response:
-                self.details_dict[self.storyteller].notification_image_sent = timezone.now()
+            notifications.append(Notification.for_match(
+                match_pk, self.number, self.status, 'notification_image_sent',
+                [self.storyteller], data))
 
         elif self.status == Round.SUBMIT_OTHERS:
             player_pks = [player_pk for player_pk, details in iteritems(self.details_dict)
                           if not (details.is_storyteller or details.notification_image_sent)]
 
             if player_pks:
-                # pylint: disable=no-member
-                storyteller = Player.objects.get(pk=self.storyteller).user.username
+                storyteller = PLAYER_PROFILES.username(self.storyteller, profiles)
                 data = {
                     'player_pks': player_pks,
                     'match_pk': match_pk,
@@ -361,11 +522,9 @@ class Round(object):
                     'message': ('Player {} has told their story, now find an image that fits'
                                 .format(storyteller)),
                 }
-                response = PUBSUB_SENDER.send_message(data=data)
-
-                if response:
-                    for player_pk in player_pks:
-                        self.details_dict[player_pk].notification_image_sent = timezone.now()
+                notifications.append(Notification.for_match(
+                    match_pk, self.number, self.status, 'notification_image_sent',
+                    player_pks, data))
 
         elif self.status == Round.SUBMIT_VOTES:
             player_pks = [player_pk for player_pk, details in iteritems(self.details_dict)
@@ -379,11 +538,9 @@ class Round(object):
                     'message': ('Everybody has submitted their image, '
                                 'now find the one that fits the story'),
                 }
-                response = PUBSUB_SENDER.send_message(data=data)
-
-                if response:
-                    for player_pk in player_pks:
-                        self.details_dict[player_pk].notification_vote_sent = timezone.now()
+                notifications.append(Notification.for_match(
+                    match_pk, self.number, self.status, 'notification_vote_sent',
+                    player_pks, data))
 
         elif self.status == Round.FINISHED:
             player_pks = [player_pk for player_pk, details in iteritems(self.details_dict)
@@ -404,11 +561,11 @@ class Round(object):
                     'title': title,
                     'message': message,
                 }
-                response = PUBSUB_SENDER.send_message(data=data)
+                notifications.append(Notification.for_match(
+                    match_pk, self.number, self.status, 'notification_finished_sent',
+                    player_pks, data))
 
-                if response:
-                    for player_pk in player_pks:
-                        self.details_dict[player_pk].notification_finished_sent = timezone.now()
+        return notifications
 
     def update_deadlines(self, delta):
         field = self.DEADLINE_FIELDS.get(self.status)
@@ -448,7 +605,94 @@ class RoundSerializer(serializers.Serializer):
         return Round(**validated_data)
 
 
+class LazyRounds(Sequence):
+    '''
+    the rounds of a match, each decoded on first access; encoding only touches
+    the rounds that were actually decoded
+    '''
+
+    __slots__ = ('match', '_data', '_rounds')
+
+    def __init__(self, data, match=None):
+        self.match = match
+        self._data = data or []
+        self._rounds = [None] * len(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        round_ = self._rounds[index]
+        if round_ is None:
+            round_ = Round.from_data(self._data[index], parent=self.match)
+            self._rounds[index] = round_
+        return round_
+
+    def peek(self, index, field):
+        '''value of a field of the given round without decoding it'''
+
+        round_ = self._rounds[index]
+        return getattr(round_, field) if round_ is not None else self._data[index].get(field)
+
+    def unfinished(self):
+        for index in range(len(self)):
+            if self.peek(index, 'status') != Round.FINISHED:
+                yield self[index]
+
+    def active(self):
+        '''rounds that are not finished or whose details were decoded'''
+
+        for index in range(len(self)):
+            round_ = self._rounds[index]
+            if ((round_ is not None and round_.details_decoded)
+                    or self.peek(index, 'status') != Round.FINISHED):
+                yield self[index]
+
+    def scores(self, index):
+        '''scores of the given round, read from the stored data if it was not decoded'''
+
+        round_ = self._rounds[index]
+        if round_ is not None and round_.details_decoded:
+            return round_.score()
+
+        if self.peek(index, 'status') != Round.FINISHED:
+            return {}
+
+        return {int(player_pk): data.get('score') or 0
+                for player_pk, data in iteritems(self._data[index].get('details') or {})}
+
+    @property
+    def is_dirty(self):
+        return any(round_ is not None and round_.is_dirty for round_ in self._rounds)
+
+    def flush(self):
+        '''encode the changed rounds back into the stored data and mark them clean'''
+
+        result = list(self._data)
+
+        for index, round_ in enumerate(self._rounds):
+            if round_ is None or not round_.is_dirty:
+                continue
+            result[index] = round_.to_data()
+            round_.details = result[index]['details']
+            round_.mark_clean()
+
+        self._data = result
+        return result
+
+
 class MatchManager(models.Manager):
+    # entity groups a cross-group transaction may span
+    WRITE_BATCH_SIZE = 25
+
+    def for_player(self, player_pk):
+        '''the matches of the given player, queried by pk without loading the player'''
+
+        return self.filter(players__contains=player_pk)
+
     def create_match(self, players, inviting_player=None, total_rounds=0, timeout=0):
         players = clear_list(players)
 
@@ -470,27 +714,25 @@ class MatchManager(models.Manager):
 
         inviting_player = inviting_player or players[0]
 
-        match_details = {player.pk: MatchDetails(player=player.pk,
-                                                 is_inviting_player=player.pk == inviting_player.pk)
-                         for player in players}
-        match_details_data = {player: MatchDetailsSerializer(instance=details).data
-                              for player, details in iteritems(match_details)}
+        match_details_data = {str(player.pk): MatchDetails(
+            player=player.pk,
+            is_inviting_player=player.pk == inviting_player.pk,
+        ).to_data() for player in players}
 
         total_rounds = total_rounds or len(players)
 
         random.shuffle(players)
 
-        rounds = [Round(
+        round_data = [Round(
             number=i + 1,
             storyteller=players[i % len(players)].pk,
             is_current_round=i == 0,
             status=Round.WAITING,
-            details={player.pk: RoundDetails(
+            details={str(player.pk): RoundDetails(
                 player=player.pk,
                 is_storyteller=players[i % len(players)].pk == player.pk,
-            ) for player in players},
-        ) for i in range(total_rounds)]
-        round_data = RoundSerializer(instance=rounds, many=True).data
+            ).to_data() for player in players},
+        ).to_data() for i in range(total_rounds)]
 
         data = {
             'players': players,
@@ -504,12 +746,106 @@ class MatchManager(models.Manager):
 
         match = self.create(**data)
 
-        for player in players:
-            player.total_matches += 1
-            player.save(new_match=match)
+        # pylint: disable=no-member
+        Player.objects.count_matches([player.pk for player in players], 1)
 
         return match
 
+    def check_matches(self, pks):
+        '''
+        check status and scores of the given matches and write the changed ones with
+        batch puts in cross-group transactions; those that changed since they were read
+        are checked again and written one by one; returns the number of matches checked
+        and written
+        '''
+
+        # pylint: disable=no-member
+        matches = list(self.filter(pk__in=pks)) if pks else []
+        changed = []
+        to_finish = []
+        written = 0
+
+        for match in matches:
+            try:
+                match.check_status()
+                match.score()
+                if match.status == Match.DELETE:
+                    match.save()
+                elif match.prepare_save():
+                    changed.append(match)
+                else:
+                    to_finish.append(match)
+            except Exception as exc:
+                LOGGER.warning('unable to check match %s', match.pk)
+                LOGGER.warning(exc)
+
+        stale = []
+        for batch in chunks(changed, self.WRITE_BATCH_SIZE):
+            try:
+                batch_written, batch_stale = self._write_batch(batch)
+            except Exception as exc:
+                LOGGER.warning('unable to write checked matches %s',
+                               [match.pk for match in batch])
+                LOGGER.warning(exc)
+                continue
+            written += len(batch_written)
+            to_finish.extend(batch_written)
+            stale.extend(batch_stale)
+
+        for match in stale:
+            try:
+                match, wrote = self._write_checked(match)
+                written += wrote
+                if match.status == Match.DELETE:
+                    match.save()
+                    continue
+                to_finish.append(match)
+            except Exception as exc:
+                LOGGER.warning('unable to check match %s', match.pk)
+                LOGGER.warning(exc)
+
+        for match in to_finish:
+            match.after_save()
+            if match.status in (Match.WAITING, Match.IN_PROGESS):
+                schedule_match(match)
+
+        return len(matches), written
+
+    def _write_batch(self, matches):
+        '''
+        write the checked matches that did not change since they were read with one
+        batch put in a transaction; returns the written and the changed matches
+        '''
+
+        with transaction.atomic(xg=True):
+            current = self.in_bulk([match.pk for match in matches])
+            unchanged = [match for match in matches if match.pk in current
+                         and current[match.pk].last_modified == match.last_modified]
+            bulk_save(unchanged)
+
+        unchanged_pks = {match.pk for match in unchanged}
+        return unchanged, [match for match in matches
+                           if match.pk in current and match.pk not in unchanged_pks]
+
+    def _write_checked(self, match):
+        '''
+        write a checked match unless it changed since it was read, e.g. by a vote; then
+        its current state is checked and written instead, so no update gets lost;
+        returns the match as written or found and whether it was written
+        '''
+
+        with transaction.atomic():
+            current = self.get(pk=match.pk)
+            if current.last_modified != match.last_modified:
+                current.check_status()
+                current.score()
+                if current.status == Match.DELETE or not current.prepare_save():
+                    return current, False
+                match = current
+            super(Match, match).save()
+
+        return match, True
+
 
 @paginated_model(orderings=('deadline_action', 'created', 'last_modified',
                             ('deadline_action', '-last_modified')))
@@ -555,22 +891,62 @@ class Match(models.Model):
     last_modified = models.DateTimeField(auto_now=True)
     finished = models.DateTimeField(blank=True, null=True, default=None)
 
+    # fields compared against their loaded values to decide whether a save needs a write
+    TRACKED_FIELDS = ('inviting_player_id', 'status', 'timeout',
+                      'deadline_response', 'deadline_action', 'finished')
+    _snapshot = None
+
     class Meta(object):
         ordering = ('deadline_action', '-last_modified')
         verbose_name_plural = 'matches'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Match, cls).from_db(db, field_names, values)
+        instance._snapshot = instance._field_state()
+        return instance
+
+    def _field_state(self):
+        state = {name: getattr(self, name, None) for name in Match.TRACKED_FIELDS}
+        # pylint: disable=no-member
+        state['players_ids'] = frozenset(self.players_ids or ())
+        state['images_ids'] = frozenset(self.images_ids or ())
+        # JSON fields are compared by identity, changes to their content go through the records
+        state['details'] = self.details
+        state['rounds'] = self.rounds
+        return state
+
+    @property
+    def is_dirty(self):
+        if self.pk is None or self._snapshot is None:
+            return True
+
+        snapshot = self._snapshot
+
+        if any(getattr(self, name, None) != snapshot[name] for name in Match.TRACKED_FIELDS):
+            return True
+
+        # pylint: disable=no-member
+        if (frozenset(self.players_ids or ()) != snapshot['players_ids']
+                or frozenset(self.images_ids or ()) != snapshot['images_ids']):
+            return True
+
+        if self.details is not snapshot['details'] or self.rounds is not snapshot['rounds']:
+            return True
+
+        if (self._details_dict is not None
+                and any(details.is_dirty for details in itervalues(self._details_dict))):
+            return True
+
+        return self._rounds_list is not None and self._rounds_list.is_dirty
+
     @property
     def details_dict(self):
         if self._details_dict is not None:
             return self._details_dict
 
-        result = {}
-        for player_pk, data in iteritems(self.details):
-            serializer = MatchDetailsSerializer(data=data)
-            serializer.is_valid(raise_exception=True)
-            result[int(player_pk)] = serializer.save(match=self)
-
-        self._details_dict = result
+        self._details_dict = {int(player_pk): MatchDetails.from_data(data, parent=self)
+                              for player_pk, data in iteritems(self.details)}
         return self._details_dict
 
     @property
@@ -578,13 +954,7 @@ class Match(models.Model):
         if self._rounds_list is not None:
             return self._rounds_list
 
-        result = []
-        for data in self.rounds:
-            serializer = RoundSerializer(data=data)
-            serializer.is_valid(raise_exception=True)
-            result.append(serializer.save(match=self))
-
-        self._rounds_list = result
+        self._rounds_list = LazyRounds(self.rounds, match=self)
         return self._rounds_list
 
     def respond(self, player_pk, accept=False):
@@ -625,10 +995,11 @@ class Match(models.Model):
                 return
 
         prev_round = None
-        # pylint: disable=no-member
-        self.images_ids.clear()
 
-        for curr_round in self.rounds_list:
+        # images of finished rounds have been added while those were in progress
+        for curr_round in self.rounds_list.unfinished():
+            if prev_round is not None and prev_round.number != curr_round.number - 1:
+                prev_round = None
             curr_round.check_status(match=self, prev_round=prev_round)
             if curr_round.is_current_round:
                 self.current_round = curr_round.number
@@ -637,16 +1008,19 @@ class Match(models.Model):
                     # pylint: disable=no-member
                     self.images_ids.add(details.image)
             prev_round = curr_round
+            if curr_round.status != Round.FINISHED:
+                # later rounds wait for this one to finish, so they are not decoded
+                break
 
-        if prev_round.status == Round.FINISHED:
+        if self.rounds_list.peek(-1, 'status') == Round.FINISHED:
             self.status = Match.FINISHED
             self.finished = self.finished or timezone.now()
 
     def score(self):
         scores = defaultdict(int)
 
-        for round_ in self.rounds_list:
-            round_scores = round_.score()
+        for index in range(len(self.rounds_list)):
+            round_scores = self.rounds_list.scores(index)
             for player_pk, value in iteritems(round_scores):
                 scores[player_pk] += value
 
@@ -656,27 +1030,32 @@ class Match(models.Model):
         return scores
 
     def send_notifications(self):
+        '''enqueue the due notifications in the outbox, they are delivered in the background'''
+
+        notifications = []
+        profiles = PLAYER_PROFILES.get_many(self.players_ids)
+
         if self.status == Match.WAITING:
             player_pks = [player_pk for player_pk, details in iteritems(self.details_dict)
                           if not details.notification_sent]
             if player_pks:
-                # pylint: disable=no-member
+                inviting_player = PLAYER_PROFILES.username(self.inviting_player_id, profiles)
                 data = {
                     'player_pks': player_pks,
-                    'match_pk': self.pk or '_new',
+                    'match_pk': self.pk,
                     'title': 'New invitation',
                     'message': ('You got an invitation from {}. Do you want to accept it?'
-                                .format(self.inviting_player.user.username)),
+                                .format(inviting_player)),
                 }
-                response = PUBSUB_SENDER.send_message(data=data)
-
-                if response:
-                    for player_pk in player_pks:
-                        self.details_dict[player_pk].notification_sent = timezone.now()
+                notifications.append(Notification.for_match(
+                    self.pk, None, self.status, 'notification_sent', player_pks, data))
 
         else:
-            for round_ in self.rounds_list:
-                round_.send_notifications(match=self)
+            for round_ in self.rounds_list.active():
+                notifications.extend(round_.send_notifications(match=self, profiles=profiles))
+
+        # pylint: disable=no-member
+        return Notification.objects.enqueue(notifications)
 
     def send_chat(self, player_pk, text, timestamp=None):
         # pylint: disable=no-member
@@ -691,41 +1070,31 @@ class Match(models.Model):
             group_id = calculate_id(self.players_ids, bits=63)
 
         # pylint: disable=no-member
-        message_group = (MessageGroup.objects
-                         .filter(group_id=group_id)
-                         .order_by('-sequence', '-last_modified')
-                         .first())
-
-        if message_group is None:
-            # pylint: disable=no-member
-            message_group = MessageGroup.objects.create(group_id=group_id)
-
-        try:
-            message = message_group.add(player_pk, text, timestamp)
-        except ValueError:
-            # pylint: disable=no-member
-            message_group = MessageGroup.objects.create(
-                group_id=group_id, sequence=message_group.sequence + 1)
-            message = message_group.add(player_pk, text, timestamp)
-        finally:
-            message_group.save()
+        message = ChatMessage.objects.append(group_id, player_pk, text, timestamp)
 
-        LOGGER.debug(message_group)
+        LOGGER.debug(message)
 
         data = {
             'player_pks': [pk for pk in self.players_ids if pk != player_pk],
             'match_pk': self.pk or '_new',
-            'title': 'New message from {}'.format(self.players.get(pk=player_pk).user.username),
+            'title': 'New message from {}'.format(PLAYER_PROFILES.username(player_pk)),
             'message': message.text,
             'sender_pk': player_pk,
             'route': 'chat',
-            'timestamp': message.timestamp.isoformat() + 'Z',
+            'timestamp': format_datetime(message.timestamp),
             'group_id': group_id,
         }
-        response = PUBSUB_SENDER.send_message(data=data)
-        LOGGER.debug(response)
+        try:
+            # pylint: disable=no-member
+            Notification.objects.enqueue([Notification(
+                key='chat-{}-{}-{}'.format(group_id, player_pk, deadline_token(message.timestamp)),
+                data=data,
+            )])
+        except Exception as exc:
+            LOGGER.warning('unable to enqueue the notification of message %s', message.pk)
+            LOGGER.warning(exc)
 
-        return message_group
+        return message
 
     def update_deadlines(self):
         delta = timedelta(seconds=self.timeout or Match.STANDARD_TIMEOUT)
@@ -736,7 +1105,7 @@ class Match(models.Model):
                                     or datetime.max.replace(tzinfo=timezone.utc))
 
         else:
-            for round_ in self.rounds_list:
+            for round_ in self.rounds_list.unfinished():
                 round_.update_deadlines(delta)
 
             if self.status == Match.IN_PROGESS:
@@ -747,36 +1116,72 @@ class Match(models.Model):
             else:
                 self.deadline_action = datetime.max.replace(tzinfo=timezone.utc)
 
-    def save(self, *args, **kwargs):
+    def save(self, notify=True, *args, **kwargs):
         if self.status == Match.DELETE:
             LOGGER.info('match %d marked for deletion', self.pk)
+            # pylint: disable=no-member
+            MatchTombstone.objects.create(match_pk=self.pk, player_pks=list(self.players_ids))
             LOGGER.info(self.delete())
 
             # pylint: disable=no-member
-            for player in self.players.all():
-                player.total_matches -= 1
-                player.save(new_match=self)
+            Player.objects.count_matches(self.players_ids, -1)
 
             return
 
+        if self.prepare_save():
+            super(Match, self).save(*args, **kwargs)
+
+        self.after_save(notify=notify)
+
+    def prepare_save(self):
+        '''
+        update deadlines and encode the changed details and rounds;
+        returns False if nothing changed and the match does not need to be written
+        '''
+
         self.update_deadlines()
 
-        stt = time.time()
-        self.send_notifications()
-        LOGGER.info('sending PubSub messages took %.3f seconds', time.time() - stt)
+        if not self.is_dirty:
+            LOGGER.debug('match %s did not change, skip writing it', self.pk)
+            return False
 
         if self._details_dict is not None:
-            self.details = {player_pk: MatchDetailsSerializer(instance=details).data
-                            for player_pk, details in iteritems(self._details_dict)}
+            changed = {str(player_pk): details.to_data()
+                       for player_pk, details in iteritems(self._details_dict)
+                       if details.is_dirty}
+            if changed:
+                details = dict(self.details or {})
+                details.update(changed)
+                self.details = details
+            for details in itervalues(self._details_dict):
+                details.mark_clean()
 
-        if self._rounds_list is not None:
-            for round_ in self._rounds_list:
-                if round_._details_dict is not None:
-                    round_.details = {player_pk: RoundDetailsSerializer(instance=details).data
-                                      for player_pk, details in iteritems(round_._details_dict)}
-            self.rounds = RoundSerializer(instance=self._rounds_list, many=True).data
+        if self._rounds_list is not None and self._rounds_list.is_dirty:
+            self.rounds = self._rounds_list.flush()
+
+        return True
+
+    def after_save(self, notify=True):
+        '''
+        take a new snapshot, schedule the next check if the deadline moved
+        and enqueue the due notifications
+        '''
+
+        previous_deadline = self._snapshot['deadline_action'] if self._snapshot else None
+
+        self._snapshot = self._field_state()
+
+        if (self.status in (Match.WAITING, Match.IN_PROGESS)
+                and self.deadline_action != previous_deadline):
+            schedule_match(self)
 
-        super(Match, self).save(*args, **kwargs)
+        if notify:
+            # the match is stored already, the next save enqueues what is still due
+            try:
+                self.send_notifications()
+            except Exception as exc:
+                LOGGER.warning('unable to enqueue notifications of match %s', self.pk)
+                LOGGER.warning(exc)
 
     def __str__(self):
         # pylint: disable=no-member
@@ -785,6 +1190,189 @@ class Match(models.Model):
                         player_pks=', '.join(map(str, self.players_ids))))
 
 
+class PlayerManager(models.Manager):
+    def count_matches(self, player_pks, delta):
+        '''
+        add delta to the total_matches counters of the given players with one batch
+        get and one batch put in a cross-group transaction, so concurrent match creates
+        and deletes don't lose counts; a match has at most MAXIMUM_PLAYER players,
+        well within the entity groups a transaction may span
+        '''
+
+        player_pks = list(set(player_pks or ()))
+        if not player_pks:
+            return []
+
+        # saving computes avatar_url from the avatar, so those are read in one batch up front
+        avatar_ids = {player.avatar_id for player in itervalues(self.in_bulk(player_pks))
+                      if player.avatar_id}
+        # pylint: disable=no-member
+        avatars = Image.objects.in_bulk(list(avatar_ids)) if avatar_ids else {}
+
+        try:
+            with transaction.atomic(xg=True):
+                players = list(itervalues(self.in_bulk(player_pks)))
+                for player in players:
+                    if player.avatar_id in avatars:
+                        player.avatar = avatars[player.avatar_id]
+                    player.total_matches = max((player.total_matches or 0) + delta, 0)
+                bulk_save(players)
+        except Exception as exc:
+            # the reconciliation job repairs the counters
+            LOGGER.warning('unable to count matches of players %s', player_pks)
+            LOGGER.warning(exc)
+            return []
+
+        return players
+
+    def reconcile_total_matches(self, player_pks):
+        '''
+        recount the matches of the given players, fix the counters that drifted
+        and return a report of players checked and drifts found; counters that
+        changed since the recount are left to the next run
+        '''
+
+        players = list(self.filter(pk__in=player_pks)) if player_pks else []
+        drifts = {}
+
+        for player in players:
+            # pylint: disable=no-member
+            actual = player.matches.count()
+            if actual == player.total_matches:
+                continue
+
+            # the avatar is another entity group, read when saving computes avatar_url
+            with transaction.atomic(xg=True):
+                current = self.get(pk=player.pk)
+                if current.total_matches != player.total_matches:
+                    continue
+                current.total_matches = actual
+                current.save()
+
+            drifts[player.pk] = actual - (player.total_matches or 0)
+
+        if drifts:
+            LOGGER.warning('total_matches drifted for %d players: %s', len(drifts), drifts)
+
+        return {'players': len(players), 'drifted': len(drifts), 'drifts': drifts}
+
+    def resolve_avatars(self, players, fetcher=None, workers=4):
+        '''
+        set the Gravatar avatar of the given players (or player pks) that have none;
+        every email hash is downloaded at most once and players sharing a hash or
+        identical content share one image, hashes without an avatar are skipped
+        '''
+
+        fetcher = fetcher or AVATAR_FETCHER
+        players = [player if isinstance(player, Player) else None for player in players]
+        missing_pks = [player for player in players if player is None]
+        players = [player for player in players if player is not None]
+        if missing_pks:
+            players.extend(self.filter(pk__in=missing_pks))
+
+        players = [player for player in players if player.pk and not player.avatar_id]
+        if not players:
+            return {'players': 0, 'resolved': 0, 'missing': 0, 'errors': 0}
+
+        users = GaeDatastoreUser.objects.in_bulk([player.user_id for player in players])
+        by_hash = defaultdict(list)
+        for player in players:
+            user = users.get(player.user_id)
+            if user and user.email:
+                by_hash[email_hash(user.email)].append(player)
+
+        image_pks = fetcher.cached_images(list(by_hash))
+        # pylint: disable=no-member
+        images = Image.objects.in_bulk(list(set(itervalues(image_pks))))
+        for gravatar, image_pk in list(iteritems(image_pks)):
+            if image_pk not in images:
+                fetcher.forget(gravatar)
+                del image_pks[gravatar]
+
+        to_fetch = [gravatar for gravatar in by_hash if gravatar not in image_pks]
+        contents = run_in_pool(fetcher.fetch, to_fetch, workers=workers)
+        errors = missing = 0
+
+        for gravatar, content in zip(to_fetch, contents):
+            if isinstance(content, Exception):
+                errors += len(by_hash[gravatar])
+                continue
+            if not content:
+                missing += len(by_hash[gravatar])
+                continue
+
+            digest = content_digest(content)
+            image_pk = fetcher.cached_content(digest)
+            if image_pk and (image_pk in images or Image.objects.filter(pk=image_pk).exists()):
+                image_pks[gravatar] = image_pk
+                fetcher.remember(gravatar, digest, image_pk)
+                continue
+
+            image = Image.objects.create_image(
+                file=ImageFile(file=BytesIO(content), name='{}.jpeg'.format(gravatar)),
+                size=len(content),
+                owner=by_hash[gravatar][0],
+                copyright=Image.OWNER,
+                info={'source': fetcher.source(gravatar), 'sha1': digest},
+            )
+            images[image.pk] = image
+            image_pks[gravatar] = image.pk
+            fetcher.remember(gravatar, digest, image.pk)
+
+        resolved = []
+        for gravatar, image_pk in iteritems(image_pks):
+            for player in by_hash[gravatar]:
+                player.avatar_id = image_pk
+                if image_pk in images:
+                    player.avatar = images[image_pk]
+                resolved.append(player)
+
+        bulk_save(resolved)
+        PLAYER_PROFILES.invalidate([player.pk for player in resolved])
+
+        return {
+            'players': len(players),
+            'resolved': len(resolved),
+            'missing': missing,
+            'errors': errors,
+        }
+
+    # pylint: disable=no-self-use
+    def send_messages(self, players, **data):
+        '''
+        send one GCM message to all players with a multicast and write back
+        canonical or unregistered registration ids in bulk
+        '''
+
+        by_registration_id = defaultdict(list)
+        for player in players:
+            if player.gcm_registration_id:
+                by_registration_id[player.gcm_registration_id].append(player)
+
+        if not by_registration_id:
+            return None
+
+        result = GCM_SENDER.send(list(by_registration_id), data)
+        LOGGER.info(result)
+
+        changed = []
+
+        for registration_id, canonical_id in iteritems(result.canonical):
+            for player in by_registration_id[registration_id]:
+                player.gcm_registration_id = canonical_id
+                changed.append(player)
+
+        for registration_id in result.unregistered:
+            for player in by_registration_id[registration_id]:
+                LOGGER.info('registration id of player %s is not registered anymore', player.pk)
+                player.gcm_registration_id = None
+                changed.append(player)
+
+        bulk_save(changed)
+
+        return result
+
+
 @paginated_model(orderings=('total_matches', 'created', 'last_modified',
                             ('-total_matches', '-last_modified')))
 @python_2_unicode_compatible
@@ -801,132 +1389,292 @@ class Player(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
 
+    objects = PlayerManager()
+
     class Meta(object):
         ordering = ('-last_modified',)
 
     def send_message(self, **data):
         if self.gcm_registration_id:
-            stt = time.time()
-            try:
-                response = GCM_SENDER.plaintext_request(registration_id=self.gcm_registration_id,
-                                                        data=data)
-            except Exception as exc:
-                LOGGER.warning(exc)
-                response = None
-            LOGGER.info('sending GCM messages took %.3f seconds', time.time() - stt)
-            return response
-
-    def fetch_avatar(self, url=None, params=None, name=None):
-        if not url:
             # pylint: disable=no-member
-            gravatar = hashlib.md5(self.user.email.lower()).hexdigest()
-            url = 'https://www.gravatar.com/avatar/{}'.format(gravatar)
-            name = name or '{}.jpeg'.format(gravatar)
-            params = params or {}
-            params['s'] = 1080
-            params['d'] = 404
-            params['r'] = 'pg'
-
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-
-        # TODO use url basename instead
-        name = name or 'avatar.jpeg'
-        image = ImageFile(file=BytesIO(response.content), name=name)
-        avatar = Image.objects.create_image(
-            file=image,
-            size=len(response.content),
-            owner=self,
-            copyright=Image.OWNER,
-            info={'source': url},
-        )
+            return Player.objects.send_messages([self], **data)
 
-        if avatar:
-            self.avatar = avatar
+    def fetch_avatar(self, fetcher=None):
+        # pylint: disable=no-member
+        Player.objects.resolve_avatars([self], fetcher=fetcher)
+        return self.avatar
 
-        return avatar
+    def save(self, *args, **kwargs):
+        # total_matches is a counter maintained by PlayerManager.count_matches
+        adding = self._state.adding
 
-    def save(self, new_match=None, *args, **kwargs):
-        # TODO inefficient - just have a counter and add sanity check method
-        try:
-            # pylint: disable=no-member
-            if not hasattr(self, 'matches') or self.matches is None:
-                self.total_matches = 0
-            elif new_match:
-                # pylint: disable=no-member
-                self.total_matches = ensure_instance_consistent(self.matches, new_match).count()
-            else:
-                # pylint: disable=no-member
-                self.total_matches = self.matches.count()
-        except Exception as exc:
-            LOGGER.warning(exc)
-            self.total_matches = 0
+        super(Player, self).save(*args, **kwargs)
 
         # pylint: disable=no-member
-        if not self.avatar_id:
-            try:
-                self.fetch_avatar()
-            except Exception as exc:
-                LOGGER.warning(exc)
-
-        super(Player, self).save(*args, **kwargs)
+        if adding and not self.avatar_id:
+            schedule_avatar(self.pk)
 
     def __str__(self):
         return str(self.user)
 
 
 class ImageManager(models.Manager):
-    def create_image(self, *args, **kwargs):
-        image = self.create(*args, **kwargs)
+    def create_image(self, file, exclude=(), **kwargs):
+        '''
+        store an uploaded image with a single write; dimensions are read from the
+        upload's header bytes before it is sent to storage, not from the stored blob;
+        images in exclude, e.g. those of the round it is submitted to, are not reused
+        '''
 
-        # TODO factor out into utils function
-        width = int(image.width) if image.width else -1
-        height = int(image.height) if image.height else -1
+        info = kwargs.get('info') or {}
+        width = kwargs.get('width')
+        height = kwargs.get('height')
 
-        # TODO set size
-        if width > 0 and height > 0:
-            return image
+        probe, content_hash = scan_file(file)
 
-        try:
-            width = image.file.width
-            height = image.file.height
-        except Exception as exc:
-            LOGGER.warning(exc)
+        duplicate = self.find_duplicate(content_hash, kwargs.get('owner'), exclude=exclude)
+        if duplicate is not None:
+            return duplicate
 
-        if width > 0 and height > 0:
-            image.width = width
-            image.height = height
+        if not (width and height):
+            width, height = probe.width, probe.height
+
+            if not (width and height):
+                width, height = _image_api_dimensions(file)
+
+            if not (width and height):
+                try:
+                    width = int(info.get('width'))
+                    height = int(info.get('height'))
+                except Exception as exc:
+                    LOGGER.warning(exc)
+
+        kwargs['width'] = width if width and width > 0 else None
+        kwargs['height'] = height if height and height > 0 else None
+
+        if not kwargs.get('size'):
+            kwargs['size'] = getattr(file, 'size', None) or probe.size or None
+
+        image = self.create(file=file, content_hash=content_hash, **kwargs)
+        schedule_variants(image.pk)
+        return image
+
+    def find_duplicate(self, content_hash, owner=None, acquire=True, exclude=()):
+        '''
+        an existing image with the same content that the owner may reuse, i.e. their
+        own or a public one that is not in exclude, by default with its reference
+        count incremented; None if there is none
+        '''
+
+        if not content_hash:
+            return None
+
+        # the pk of a player or lazy player, without loading the latter
+        owner_pk = getattr(owner, 'pk', owner)
+        candidates = self.filter(content_hash=content_hash)[:10]
+        duplicate = next((image for image in candidates
+                          if image.pk not in exclude and
+                          (image.is_available_publicly or
+                           (owner_pk and image.owner_id == owner_pk))), None)
+
+        if duplicate is None:
+            IMAGE_DEDUPE.incr('misses')
+            return None
+
+        IMAGE_DEDUPE.incr('hits')
+        return self.acquire(duplicate.pk) if acquire else duplicate
+
+    def acquire(self, pk, receipt=None):
+        '''
+        add a reference to the image; with a receipt, e.g. the hash of an upload token,
+        only the first call adds one and replays return the image as it is
+        '''
+
+        # pylint: disable=no-member
+        with transaction.atomic(xg=bool(receipt)):
+            image = self.get(pk=pk)
+            if receipt and UploadReceipt.objects.filter(pk=receipt).exists():
+                return image
+            image.ref_count = (image.ref_count or 1) + 1
             image.save()
-            return image
+            if receipt:
+                UploadReceipt.objects.create(pk=receipt, image_pk=pk)
+        return image
+
+    def release(self, pk):
+        '''
+        drop a reference to the image; the last one deletes the entity and,
+        once that is committed, the original and its variants from storage
+        '''
+
+        with transaction.atomic():
+            image = self.get(pk=pk)
+            image.ref_count = (image.ref_count or 1) - 1
+            if image.ref_count > 0:
+                image.save()
+                return image
+            image.delete()
+
+        IMAGE_DEDUPE.incr('deleted')
+
+        names = [image.file.name] + [
+            '{}.{}.{}'.format(os.path.splitext(image.file.name)[0], name, variant.get('format'))
+            for name, variant in (image.variants or {}).items()]
+
+        for name in names:
+            try:
+                STORAGE.delete(name)
+            except Exception as exc:
+                LOGGER.warning('unable to delete %s from storage', name)
+                LOGGER.warning(exc)
+
+        return None
+
+    def create_uploaded_image(self, name, storage=None, exclude=(), receipt=None, **kwargs):
+        '''
+        create the image for an object the client put into storage directly, or reuse
+        an existing image with the same content and delete the object; the object is
+        read once to probe and hash it, finalizing with the same receipt twice is a no-op
+        '''
+
+        existing = self.filter(file=name).first()
+        if existing is not None:
+            return existing
 
+        # pylint: disable=no-member
+        finalized = UploadReceipt.objects.filter(pk=receipt).first() if receipt else None
+        if finalized is not None:
+            return self.get(pk=finalized.image_pk)
+
+        storage = storage or get_upload_storage()
+        size = storage.size(name)
+
+        if size > MAX_UPLOAD_SIZE:
+            storage.delete(name)
+            raise ValueError('uploaded image is larger than {} bytes'.format(MAX_UPLOAD_SIZE))
+
+        upload = storage.open(name)
         try:
-            # pylint: disable=import-error
-            import google.appengine.api.images
-            image.file.open(mode='r')
-            image_obj = google.appengine.api.images.Image(image_data=image.file.read())
-            width = image_obj.width
-            height = image_obj.height
-        except Exception as exc:
-            LOGGER.warning(exc)
+            probe, content_hash = scan_file(upload)
         finally:
-            image.file.close()
+            upload.close()
 
-        if width > 0 and height > 0:
-            image.width = width
-            image.height = height
-            image.save()
+        if not probe.format:
+            storage.delete(name)
+            raise ValueError('uploaded file is not a supported image')
+
+        duplicate = self.find_duplicate(
+            content_hash, kwargs.get('owner'), acquire=False, exclude=exclude)
+        if duplicate is not None:
+            image = self.acquire(duplicate.pk, receipt=receipt)
+            storage.delete(name)
             return image
 
+        image = self.create(
+            file=name,
+            width=probe.width or None,
+            height=probe.height or None,
+            size=size,
+            content_hash=content_hash,
+            **kwargs
+        )
+        schedule_variants(image.pk)
+        return image
+
+    # pylint: disable=no-self-use
+    def create_variants(self, image, content=None, variants=None):
+        '''
+        render the image's missing variants and store them next to the original;
+        variants already recorded on the image or already in storage are never
+        encoded again, and concurrent runs for the same image back off
+        '''
+
+        variants = variants or VARIANTS
+        result = dict(image.variants or {})
+        missing = [name for name in variants if name not in result]
+
+        if not missing:
+            return result
+
+        lock = 'image-variants-{}'.format(image.pk)
+        if not cache.add(lock, True, VARIANTS_LOCK_TIMEOUT):
+            LOGGER.info('variants of image %s are being created already', image.pk)
+            return result
+
         try:
-            width = int(image.info.get('width'))
-            height = int(image.info.get('height'))
-        except Exception as exc:
-            LOGGER.warning(exc)
+            base = os.path.splitext(image.file.name)[0]
 
-        image.width = width if width and width > 0 else None
-        image.height = height if height and height > 0 else None
-        image.save()
-        return image
+            for name in missing:
+                spec = variants[name]
+                path = '{}.{}.{}'.format(base, name, spec.format)
+
+                if STORAGE.exists(path):
+                    with STORAGE.open(path) as file:
+                        header = probe_file(file).header
+                    size = STORAGE.size(path)
+                else:
+                    if content is None:
+                        with STORAGE.open(image.file.name) as file:
+                            content = file.read()
+                    data, header = render_variant(content, spec, image.width, image.height)
+                    path = STORAGE.save(path, ContentFile(data))
+                    size = len(data)
+
+                result[name] = {
+                    'url': STORAGE.url(path),
+                    'width': header.width,
+                    'height': header.height,
+                    'size': size,
+                    'format': spec.format,
+                }
+
+            # a raw put without save and its pool update; pre_save still bumps
+            # last_modified and its pagination field, so ETags change with the variants
+            with transaction.atomic():
+                current = self.get(pk=image.pk)
+                current.variants = result
+                bulk_save([current])
+            image.variants = result
+            image.last_modified = current.last_modified
+
+        finally:
+            cache.delete(lock)
+
+        return result
+
+    def random_slice(self, size, queryset=None, pivot=None):
+        '''
+        up to size consecutive images in random_order from a random pivot, wrapping
+        around at the end. This is not a uniform subset: an image's chance to be
+        included grows with the gap in front of its key. Draw from the image pool
+        for uniform samples.
+        '''
+
+        queryset = self.all() if queryset is None else queryset
+        pivot = random_integer() if pivot is None else pivot
+
+        result = list(queryset.filter(random_order__gte=pivot).order_by('random_order')[:size])
+        if len(result) < size:
+            result.extend(queryset.filter(random_order__lt=pivot)
+                          .order_by('random_order')[:size - len(result)])
+
+        return result
+
+
+def _image_api_dimensions(file):
+    '''fallback for formats the header probe doesn't know, reads the whole local upload'''
+
+    try:
+        # pylint: disable=import-error
+        import google.appengine.api.images
+        position = file.tell()
+        image_obj = google.appengine.api.images.Image(image_data=file.read())
+        file.seek(position)
+        return image_obj.width, image_obj.height
+    except Exception as exc:
+        LOGGER.warning(exc)
+
+    return None, None
 
 
 @paginated_model(orderings=('random_order', 'created', 'last_modified'))
@@ -958,19 +1706,42 @@ class Image(models.Model):
                               blank=True, null=True, on_delete=models.SET_NULL)
     copyright = fields.CharField(max_length=1, choices=COPYRIGHTS, default=OWNER)
     info = fields.JSONField(blank=True, null=True)
+    variants = fields.JSONField(blank=True, null=True)
+    # SHA-256 of the original, identical uploads share one image
+    content_hash = fields.CharField(max_length=64, blank=True, null=True)
+    ref_count = models.PositiveIntegerField(default=1)
     is_available_publicly = fields.ComputedBooleanField(
         func=lambda image: image.copyright in (image.DIRIS, image.PUBLIC),
         default=False,
     )
-    random_order = fields.ComputedIntegerField(func=random_integer, default=random_integer)
+    # fixed when the image is created, random access picks a random point in this order
+    random_order = models.IntegerField(default=random_integer)
     created = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
 
+    _pool_state = (False, None)
+
     class Meta(object):
         ordering = ('-last_modified',)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Image, cls).from_db(db, field_names, values)
+        instance._pool_state = (instance.is_available_publicly, instance.owner_id)
+        return instance
+
+    def save(self, *args, **kwargs):
+        super(Image, self).save(*args, **kwargs)
+
+        was_public, previous_owner = self._pool_state
+        # pylint: disable=no-member
+        if (self.is_available_publicly, self.owner_id) != self._pool_state:
+            IMAGE_POOL.update(self, was_public=was_public, previous_owner=previous_owner)
+            self._pool_state = (self.is_available_publicly, self.owner_id)
+
     def is_available_to(self, player=None):
-        return self.is_available_publicly or (player and player == self.owner)
+        return self.is_available_publicly or (
+            player is not None and player.pk == self.owner_id)
 
     def __str__(self):
         return self.url
@@ -1044,3 +1815,357 @@ class MessageGroup(models.Model):
 
     def __str__(self):
         return 'message group <{}> #{}'.format(self.group_id, self.sequence)
+
+
+class ChatMessageManager(models.Manager):
+    def append(self, group_id, player_pk, text, timestamp=None):
+        '''
+        store one message and advance the group's head; both are writes by key,
+        so posting costs the same however long the chat is
+        '''
+
+        # pylint: disable=no-member
+        head = ChatHead.objects.filter(pk=group_id).first()
+        if head is None or not head.legacy_imported:
+            self.import_legacy(group_id)
+
+        message = self.create(group_id=group_id, player=player_pk, text=text,
+                              timestamp=timestamp or timezone.now())
+
+        with transaction.atomic():
+            head = ChatHead.objects.get(pk=group_id)
+            head.count += 1
+            if not head.last_timestamp or message.timestamp >= head.last_timestamp:
+                head.last_timestamp = message.timestamp
+                head.last_message = message.pk
+            head.save()
+
+        return message
+
+    def import_legacy(self, group_id):
+        '''
+        copy the messages of the group's legacy message groups and mark its head as
+        imported, creating it if need be; the copies have keys derived from their
+        position, so concurrent or repeated imports write the same entities
+        '''
+
+        # pylint: disable=no-member
+        groups = list(MessageGroup.objects.filter(group_id=group_id))
+        messages = [
+            ChatMessage(pk=calculate_id(['{}-{}'.format(group.pk, index)], bits=63),
+                        group_id=group_id, player=message.player, text=message.text,
+                        timestamp=message.timestamp)
+            for group in groups
+            for index, message in enumerate(group.messages_list)
+        ]
+        bulk_save(messages)
+
+        with transaction.atomic():
+            try:
+                head = ChatHead.objects.get(pk=group_id)
+            except ChatHead.DoesNotExist:
+                head = ChatHead(group_id=group_id)
+
+            if head.legacy_imported:
+                return head
+
+            head.count += len(messages)
+            head.legacy_sequence = max(group.sequence for group in groups) if groups else None
+            for message in messages:
+                if not head.last_timestamp or message.timestamp > head.last_timestamp:
+                    head.last_timestamp = message.timestamp
+                    head.last_message = message.pk
+            head.legacy_imported = True
+            head.save()
+
+        LOGGER.info('imported %d legacy messages of chat %s', len(messages), group_id)
+        return head
+
+    def page(self, group_id, after=None, since=None, before=None, size=50):
+        '''
+        up to size messages of the group after the cursor position (a pagination
+        value) or timestamp, oldest first, and whether there are newer ones; before
+        a cursor position or without any the latest size messages before it, and
+        whether there are older ones
+        '''
+
+        messages = self.filter(group_id=group_id)
+
+        if not after and not since:
+            if before:
+                messages = messages.filter(pagination_timestamp__lt=before)
+            latest = list(messages.order_by('-pagination_timestamp')[:size + 1])
+            return latest[:size][::-1], len(latest) > size
+
+        if after:
+            messages = messages.filter(pagination_timestamp__gt=after)
+            messages = messages.order_by('pagination_timestamp')
+        else:
+            # the first sort order has to be the property of the inequality filter
+            messages = messages.filter(timestamp__gt=since).order_by('timestamp')
+
+        messages = list(messages[:size + 1])
+        return messages[:size], len(messages) > size
+
+
+@paginated_model(orderings=('timestamp',))
+@python_2_unicode_compatible
+class ChatMessage(models.Model):
+    '''one message of a chat, written once and never rewritten'''
+
+    objects = ChatMessageManager()
+
+    group_id = models.BigIntegerField()
+    player = models.BigIntegerField()
+    text = models.TextField()
+    timestamp = models.DateTimeField()
+
+    class Meta(object):
+        ordering = ('timestamp',)
+
+    def __str__(self):
+        return '<{}> {}'.format(self.timestamp, self.text)
+
+
+@python_2_unicode_compatible
+class ChatHead(models.Model):
+    '''pointer to the newest message of a chat, keyed by group_id'''
+
+    group_id = models.BigIntegerField(primary_key=True)
+    count = models.PositiveIntegerField(default=0)
+    last_message = models.BigIntegerField(blank=True, null=True)
+    last_timestamp = models.DateTimeField(blank=True, null=True)
+    last_modified = models.DateTimeField(auto_now=True)
+    # whether the messages of the legacy message groups were copied, and their last sequence
+    legacy_imported = models.BooleanField(default=False)
+    legacy_sequence = models.IntegerField(blank=True, null=True)
+
+    def __str__(self):
+        return 'chat <{}> with {} messages'.format(self.group_id, self.count)
+
+
+class NotificationManager(models.Manager):
+    def enqueue(self, notifications):
+        '''store the notifications not yet in the outbox and trigger their delivery'''
+
+        notifications = {notification.pk: notification
+                         for notification in notifications if notification is not None}
+
+        if not notifications:
+            return []
+
+        # keys are deterministic, so outbox records seen before need no datastore read
+        keys = {Notification.ENQUEUED_KEY.format(pk): pk for pk in notifications}
+        known = {keys[key] for key in cache.get_many(list(keys))}
+        new = [notification for key, notification in iteritems(notifications)
+               if key not in known and self._create_once(notification)]
+
+        cache.set_many({key: True for key in keys}, Notification.ENQUEUED_TIMEOUT)
+
+        if new:
+            schedule_notifications_drain()
+
+        return new
+
+    def _create_once(self, notification):
+        '''insert the record unless it exists, concurrent callers create it only once'''
+
+        with transaction.atomic():
+            if self.filter(pk=notification.pk).exists():
+                return False
+            notification.save(force_insert=True)
+        return True
+
+    def _claim(self, pk, now):
+        '''lease a pending notification to this drain, None if another drain holds it'''
+
+        with transaction.atomic():
+            notification = self.filter(pk=pk).first()
+            if (notification is None or notification.status != Notification.PENDING
+                    or (notification.leased_until and notification.leased_until > now)):
+                return None
+            notification.leased_until = now + Notification.LEASE
+            notification.save()
+        return notification
+
+    def drain(self, limit=100, workers=8):
+        '''
+        publish pending notifications, each claimed with a lease first so concurrent
+        drains never send the same one twice, and once delivery is acknowledged commit
+        the matches' notification timestamps; returns the number of processed and delivered
+        '''
+
+        now = timezone.now()
+        # pylint: disable=no-member
+        pks = list(self.filter(status=Notification.PENDING)
+                   .order_by('created').values_list('pk', flat=True)[:limit])
+        claimed = run_in_pool(lambda pk: self._claim(pk, now), pks, workers=workers)
+        pending = [notification for notification in claimed
+                   if isinstance(notification, Notification)]
+        delivered = []
+
+        stt = time.time()
+        message_ids = PUBSUB_SENDER.send_messages([notification.data for notification in pending])
+
+        for notification, message_id in zip(pending, message_ids):
+            notification.attempts += 1
+            notification.leased_until = None
+            if message_id:
+                notification.status = Notification.SENT
+                notification.sent = timezone.now()
+                delivered.append(notification)
+            elif notification.attempts >= Notification.MAX_ATTEMPTS:
+                LOGGER.warning('giving up on notification <%s>', notification.pk)
+                notification.status = Notification.FAILED
+        LOGGER.info('sending %d PubSub messages took %.3f seconds',
+                    len(pending), time.time() - stt)
+
+        by_match = defaultdict(list)
+        for notification in delivered:
+            if notification.match_pk and notification.field:
+                by_match[notification.match_pk].append(notification)
+
+        for match_pk, notifications in iteritems(by_match):
+            try:
+                self._acknowledge(match_pk, notifications)
+            except Exception as exc:
+                LOGGER.warning('unable to acknowledge notifications of match %s', match_pk)
+                LOGGER.warning(exc)
+
+        bulk_save(pending)
+
+        if len(pks) >= limit:
+            schedule_notifications_drain()
+
+        return len(pending), len(delivered)
+
+    # pylint: disable=no-self-use
+    def _acknowledge(self, match_pk, notifications):
+        # the timestamps are part of the match's data, so its version changes with them
+        with transaction.atomic():
+            # pylint: disable=no-member
+            match = Match.objects.get(pk=match_pk)
+
+            for notification in notifications:
+                details_dict = (match.details_dict if notification.round_number is None
+                                else match.rounds_list[notification.round_number - 1].details_dict)
+                for player_pk in notification.player_pks or ():
+                    details = details_dict.get(player_pk)
+                    if details is not None and not getattr(details, notification.field):
+                        setattr(details, notification.field, notification.sent)
+
+            match.save(notify=False)
+
+    def purge(self, before, limit=500):
+        '''delete up to limit sent or failed notifications last modified before the given time'''
+
+        pks = []
+        for status in (Notification.SENT, Notification.FAILED):
+            pks.extend(self.filter(status=status, last_modified__lt=before)
+                       .values_list('pk', flat=True)[:limit - len(pks)])
+            if len(pks) >= limit:
+                break
+        if pks:
+            self.filter(pk__in=pks).delete()
+        return len(pks)
+
+
+@python_2_unicode_compatible
+class Notification(models.Model):
+    '''outbox record of a push notification, delivered in the background'''
+
+    PENDING = 'p'
+    SENT = 's'
+    FAILED = 'f'
+    STATUSES = (
+        (PENDING, 'pending'),
+        (SENT, 'sent'),
+        (FAILED, 'failed'),
+    )
+    MAX_ATTEMPTS = 5
+    # delivered and failed records are kept this long
+    RETENTION = timedelta(days=7)
+    # a drain that claimed notifications has this long to publish them
+    LEASE = timedelta(minutes=2)
+    ENQUEUED_KEY = 'notification-enqueued-{}'
+    ENQUEUED_TIMEOUT = 60 * 60 * 24
+
+    objects = NotificationManager()
+
+    # deterministic, so the same notification is never enqueued twice
+    key = models.CharField(primary_key=True, max_length=500)
+    match_pk = models.BigIntegerField(blank=True, null=True)
+    round_number = models.PositiveSmallIntegerField(blank=True, null=True)
+    # details field the notification is about, for the player_pks
+    field = models.CharField(max_length=30, blank=True, null=True)
+    player_pks = fields.JSONField(default=list)
+    data = fields.JSONField()
+    status = fields.CharField(max_length=1, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    last_modified = models.DateTimeField(auto_now=True)
+    sent = models.DateTimeField(blank=True, null=True, default=None)
+    leased_until = models.DateTimeField(blank=True, null=True, default=None)
+
+    class Meta(object):
+        ordering = ('created',)
+
+    @classmethod
+    def for_match(cls, match_pk, round_number, status, field, player_pks, data):
+        if not match_pk:
+            return None
+
+        return cls(
+            key='match-{}-{}-{}'.format(match_pk, round_number or 0, status),
+            match_pk=match_pk,
+            round_number=round_number,
+            field=field,
+            player_pks=player_pks,
+            data=data,
+        )
+
+    def __str__(self):
+        return 'notification <{}>'.format(self.pk)
+
+
+class MatchTombstoneManager(models.Manager):
+    def purge(self, before, limit=500):
+        '''delete up to limit tombstones created before the given time'''
+
+        pks = list(self.filter(created__lt=before).values_list('pk', flat=True)[:limit])
+        if pks:
+            self.filter(pk__in=pks).delete()
+        return len(pks)
+
+
+@paginated_model(orderings=('created',))
+@python_2_unicode_compatible
+class MatchTombstone(models.Model):
+    '''record of a deleted match, so syncing clients learn about the deletion'''
+
+    # tombstones are kept this long, older sync cursors have to start over
+    RETENTION = timedelta(days=30)
+
+    objects = MatchTombstoneManager()
+
+    match_pk = models.BigIntegerField()
+    player_pks = fields.ListField(models.BigIntegerField())
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta(object):
+        ordering = ('created',)
+
+    def __str__(self):
+        return 'tombstone of match <{}>'.format(self.match_pk)
+
+
+@python_2_unicode_compatible
+class UploadReceipt(models.Model):
+    '''the image an upload token was finalized with, so replays do not add references'''
+
+    token_hash = models.CharField(max_length=64, primary_key=True)
+    image_pk = models.BigIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return 'receipt for image <{}>'.format(self.image_pk)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+'''cached display data of players, for notifications and chat'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import logging
+
+from django.core.cache import cache
+
+LOGGER = logging.getLogger(__name__)
+
+PROFILE_KEY = 'player-profile-{}'
+PROFILE_TIMEOUT = 60 * 60 * 24
+
+
+class PlayerProfiles(object):
+    '''
+    username and avatar URL per player pk, read through to Player and its user
+    with one batch get each for all players missing in the cache
+    '''
+
+    # pylint: disable=no-self-use
+    def _load(self, pks):
+        from djangae.contrib.gauth_datastore.models import GaeDatastoreUser
+        from .models import Player
+
+        # pylint: disable=no-member
+        players = Player.objects.in_bulk(pks)
+        users = GaeDatastoreUser.objects.in_bulk([player.user_id for player in players.values()])
+
+        result = {}
+        for pk, player in players.items():
+            user = users.get(player.user_id)
+            result[pk] = {
+                'pk': pk,
+                'username': user.username if user else None,
+                'avatar_url': player.avatar_url,
+            }
+        return result
+
+    def get_many(self, pks):
+        '''profiles of the given players by pk, players that don't exist are left out'''
+
+        pks = list(set(pks or ()))
+        if not pks:
+            return {}
+
+        keys = {PROFILE_KEY.format(pk): pk for pk in pks}
+        cached = cache.get_many(list(keys))
+        result = {keys[key]: profile for key, profile in cached.items()}
+
+        missing = [pk for pk in pks if pk not in result]
+        if missing:
+            loaded = self._load(missing)
+            cache.set_many({PROFILE_KEY.format(pk): profile for pk, profile in loaded.items()},
+                           PROFILE_TIMEOUT)
+            result.update(loaded)
+
+        return result
+
+    def get(self, pk):
+        return self.get_many([pk]).get(pk)
+
+    def username(self, pk, profiles=None):
+        '''the player's username, from the given prefetched profiles if possible'''
+
+        profile = (profiles or {}).get(pk) or self.get(pk)
+        return profile['username'] if profile else None
+
+    def invalidate(self, pks):
+        cache.delete_many([PROFILE_KEY.format(pk) for pk in pks if pk])
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+'''sampled request profiles, aggregated per route and time window'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import cProfile
+import logging
+import pstats
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import random
+
+LOGGER = logging.getLogger(__name__)
+
+PROFILE_KEY = 'profile-{}'
+# in the order of the values per function
+SORT_KEYS = ('calls', 'tottime', 'cumtime')
+
+
+def function_label(func):
+    filename, line, name = func
+    return '{}:{}({})'.format(filename, line, name)
+
+
+def merge_functions(target, source):
+    '''add the calls and times of source to target, both label to [calls, tottime, cumtime]'''
+
+    for label, values in source.items():
+        current = target.setdefault(label, [0, 0.0, 0.0])
+        for index, value in enumerate(values):
+            current[index] += value
+    return target
+
+
+class RouteProfiler(object):
+    '''
+    profiles a share of requests with a profiler per thread and adds their stats up per
+    route; the functions with the highest times are flushed to the cache every few
+    samples, where the profiles of all instances are merged per time window. Concurrent
+    flushes may lose each other's samples, which is fine for statistics.
+    '''
+
+    def __init__(self, rate=.01, window=15 * 60, keep=50, flush_every=20):
+        self.rate = rate
+        self.window = window
+        self.keep = keep
+        self.flush_every = flush_every
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._samples = 0
+        self._window_start = self.window_start()
+
+    def window_start(self, now=None):
+        now = time.time() if now is None else now
+        return int(now // self.window * self.window)
+
+    def start(self, force=False):
+        '''start profiling the current thread's request if it is sampled'''
+
+        # a request that never got to its response leaves its profile behind
+        previous = getattr(self._local, 'profile', None)
+        if previous is not None:
+            previous.disable()
+
+        if not (force or (self.rate > 0 and random.random() < self.rate)):
+            self._local.profile = None
+            return False
+
+        profile = cProfile.Profile()
+        self._local.profile = profile
+        self._local.started = time.time()
+        profile.enable()
+        return True
+
+    def stop(self, route):
+        '''stop profiling the current thread and add its stats to the route'''
+
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            return False
+
+        profile.disable()
+        seconds = time.time() - self._local.started
+        self._local.profile = None
+
+        stats = pstats.Stats(profile)
+        window_start = self.window_start()
+
+        with self._lock:
+            if window_start != self._window_start:
+                routes, previous = self._take()
+                self._window_start = window_start
+            else:
+                routes = previous = None
+
+            aggregate = self._routes.setdefault(route, {'requests': 0, 'seconds': 0.0,
+                                                        'stats': None})
+            aggregate['requests'] += 1
+            aggregate['seconds'] += seconds
+            if aggregate['stats'] is None:
+                aggregate['stats'] = stats
+            else:
+                aggregate['stats'].add(stats)
+
+            self._samples += 1
+            if routes is None and self._samples >= self.flush_every:
+                routes, previous = self._take()
+
+        if routes:
+            self._write(previous, routes)
+
+        return True
+
+    def _take(self):
+        # called with the lock held
+        routes, self._routes, self._samples = self._routes, {}, 0
+        return routes, self._window_start
+
+    def _summary(self, aggregate):
+        functions = {function_label(func): [calls, tottime, cumtime]
+                     for func, (_, calls, tottime, cumtime, _)
+                     in aggregate['stats'].stats.items()}
+        # the cache keeps the functions with the highest own and the highest total times
+        top = set()
+        for index in (1, 2):
+            top.update(sorted(functions, key=lambda label, index=index: functions[label][index],
+                              reverse=True)[:self.keep])
+        return {
+            'requests': aggregate['requests'],
+            'seconds': aggregate['seconds'],
+            'functions': {label: functions[label] for label in top},
+        }
+
+    def _write(self, window_start, routes):
+        key = PROFILE_KEY.format(window_start)
+        try:
+            data = cache.get(key) or {}
+            for route, aggregate in routes.items():
+                summary = self._summary(aggregate)
+                current = data.setdefault(route, {'requests': 0, 'seconds': 0.0,
+                                                  'functions': {}})
+                current['requests'] += summary['requests']
+                current['seconds'] += summary['seconds']
+                merge_functions(current['functions'], summary['functions'])
+            # keep the current and the previous window
+            cache.set(key, data, self.window * 2)
+        except Exception as exc:
+            LOGGER.warning('unable to write profiles of window %s', window_start)
+            LOGGER.warning(exc)
+
+    def flush(self):
+        '''write this instance's samples to the cache now'''
+
+        with self._lock:
+            routes, window_start = self._take()
+        if routes:
+            self._write(window_start, routes)
+
+    def report(self, window_start=None, route=None, top=20, sort='tottime'):
+        '''the top functions per route of a window, the current one by default'''
+
+        window_start = self.window_start() if window_start is None else window_start
+        index = SORT_KEYS.index(sort) if sort in SORT_KEYS else 1
+        data = cache.get(PROFILE_KEY.format(window_start)) or {}
+
+        routes = {}
+        for name, summary in data.items():
+            if route and name != route:
+                continue
+            functions = sorted(summary['functions'].items(),
+                               key=lambda item: item[1][index], reverse=True)
+            routes[name] = {
+                'requests': summary['requests'],
+                'mean_seconds': (summary['seconds'] / summary['requests']
+                                 if summary['requests'] else None),
+                'functions': [{
+                    'function': label,
+                    'calls': calls,
+                    'tottime': round(tottime, 6),
+                    'cumtime': round(cumtime, 6),
+                } for label, (calls, tottime, cumtime) in functions[:top]],
+            }
+
+        return {
+            'window_start': window_start,
+            'window': self.window,
+            'rate': self.rate,
+            'sort': SORT_KEYS[index],
+            'routes': routes,
+        }
+
+
+PROFILER = RouteProfiler(rate=settings.PROFILE_SAMPLE_RATE, window=settings.PROFILE_WINDOW)
@@ -10,6 +10,8 @@ from __future__ import absolute_import, unicode_literals
 
 import json
 import logging
+import threading
+import time
 
 from base64 import b64encode
 
@@ -22,62 +24,133 @@ from django.conf import settings
 # pylint: disable=import-error
 from google.appengine.api import app_identity
 # pylint: disable=import-error
-from google.appengine.api import memcache
-# pylint: disable=import-error
 from oauth2client.client import GoogleCredentials
 
 LOGGER = logging.getLogger(__name__)
 PUBSUB_SCOPES = ['https://www.googleapis.com/auth/pubsub']
+# maximum number of messages in one publish request
+MAX_BATCH_SIZE = 1000
+HTTP_TIMEOUT = 10
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+class PubSubClient(object):
+    '''discovery client shared between threads, each thread gets its own authorized connection'''
+
+    def __init__(self, credentials):
+        if credentials.create_scoped_required():
+            credentials = credentials.create_scoped(PUBSUB_SCOPES)
+
+        self.credentials = credentials
+        self.local = threading.local()
+        self.service = discovery.build('pubsub', 'v1', http=self.http())
+
+    def http(self):
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            http = self.credentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT))
+            self.local.http = http
+        return http
 
-def get_client_from_credentials(credentials):
-    if credentials.create_scoped_required():
-        credentials = credentials.create_scoped(PUBSUB_SCOPES)
+    def publish(self, topic, messages):
+        return self.service.projects().topics().publish(
+            topic=topic,
+            body={'messages': messages},
+        ).execute(http=self.http())
 
-    http = httplib2.Http(memcache)
-    credentials.authorize(http)
 
-    return discovery.build('pubsub', 'v1', http=http)
+def get_client():
+    '''the shared Pub/Sub client, created on first use'''
+
+    global _CLIENT  # pylint: disable=global-statement
+
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = PubSubClient(GoogleCredentials.get_application_default())
+        return _CLIENT
+
 
 class PubSubSender(object):
-    def __init__(self, project_id=None, topic_name=None):
+    def __init__(self, project_id=None, topic_name=None, publisher=None):
+        self.lock = threading.Lock()
+        self.counters = {'batches': 0, 'messages': 0, 'failures': 0, 'seconds': 0.0}
+        self.publisher = publisher
+        self.full_topic_name = None
+
         try:
-            self.client = get_client_from_credentials(GoogleCredentials.get_application_default())
+            self.publisher = publisher or get_client().publish
 
             project_id = project_id or app_identity.get_application_id()
             topic_name = topic_name or settings.PUBSUB_NOTIFICATIONS_TOPIC
             self.full_topic_name = 'projects/{}/topics/{}'.format(project_id, topic_name)
         except Exception as exc:
             LOGGER.warning(exc)
-            self.client = None
-            self.full_topic_name = None
 
-    def send_message(self, data=None, attributes=None):
-        if not (self.client and self.full_topic_name):
-            return
+    @property
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['average_latency'] = (stats['seconds'] / stats['batches']
+                                    if stats['batches'] else None)
+        return stats
 
+    @staticmethod
+    def encode(data=None, attributes=None):
         data = data or ''
         if not isinstance(data, six.string_types):
             data = json.dumps(data)
 
-        attributes = attributes or {}
-
-        body = {
-            'messages': [{
-                'data': b64encode(data.encode('utf-8')),
-                'attributes': attributes,
-            }]
+        return {
+            'data': b64encode(data.encode('utf-8')),
+            'attributes': attributes or {},
         }
 
-        LOGGER.info('publish message; topic: %s; data: %s; attributes: %s',
-                    self.full_topic_name, data, attributes)
+    def send_message(self, data=None, attributes=None):
+        if not (self.publisher and self.full_topic_name):
+            return
+
+        message_ids = self.send_messages([data], attributes=attributes)
+        return {'messageIds': message_ids} if message_ids[0] else None
+
+    def send_messages(self, messages, attributes=None):
+        '''
+        publish the given data objects with as few requests as possible;
+        returns their message ids in order, None for messages that failed
+        '''
+
+        return self.publish([self.encode(data, attributes) for data in messages])
 
+    def publish(self, messages):
+        '''publish encoded messages in batches of at most MAX_BATCH_SIZE'''
+
+        if not (self.publisher and self.full_topic_name):
+            return [None] * len(messages)
+
+        message_ids = []
+        for start in range(0, len(messages), MAX_BATCH_SIZE):
+            message_ids.extend(self._publish(messages[start:start + MAX_BATCH_SIZE]))
+        return message_ids
+
+    def _publish(self, messages):
+        LOGGER.info('publish %d message(s); topic: %s', len(messages), self.full_topic_name)
+
+        stt = time.time()
         try:
-            response = self.client.projects().topics().publish(
-                topic=self.full_topic_name,
-                body=body,
-            ).execute()
+            response = self.publisher(self.full_topic_name, messages)
+            message_ids = list((response or {}).get('messageIds') or ())
         except Exception as exc:
             LOGGER.warning(exc)
-            response = None
+            message_ids = []
+        seconds = time.time() - stt
+
+        message_ids.extend([None] * (len(messages) - len(message_ids)))
+
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['messages'] += len(messages)
+            self.counters['failures'] += sum(1 for message_id in message_ids if not message_id)
+            self.counters['seconds'] += seconds
 
-        return response
+        return message_ids
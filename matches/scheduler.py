@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+'''schedule match checks at their next deadline and deliveries of notifications'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import calendar
+import logging
+import time
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .tasks import get_task_queue
+
+LOGGER = logging.getLogger(__name__)
+
+NO_DEADLINE = datetime.max.replace(tzinfo=timezone.utc)
+# run a little after the deadline so the check sees it as passed
+GRACE_PERIOD = timedelta(seconds=1)
+# checks that found their deadline pending run again with growing delays, then the
+# daily sweep takes over
+MAX_RETRIES = 5
+RETRY_DELAY = timedelta(seconds=30)
+
+
+def deadline_token(deadline):
+    '''identifies a deadline in task names and parameters'''
+
+    return '{:d}{:06d}'.format(calendar.timegm(deadline.utctimetuple()), deadline.microsecond)
+
+
+def task_name(match_pk, deadline, attempt=0):
+    name = 'match-{}-{}'.format(match_pk, deadline_token(deadline))
+    return '{}-retry{}'.format(name, attempt) if attempt else name
+
+
+def schedule_match(match, queue=None, attempt=0):
+    '''
+    enqueue a check of the match at its next deadline, or a retry of a check that
+    found it still pending; tasks are named after match, deadline and attempt, so
+    scheduling the same one again is a no-op
+    '''
+
+    deadline = match.deadline_action
+
+    if not match.pk or not deadline or deadline >= NO_DEADLINE or attempt > MAX_RETRIES:
+        return False
+
+    queue = queue or get_task_queue(settings.MATCH_SCHEDULER_QUEUE)
+    eta = (max(deadline, timezone.now()) + RETRY_DELAY * 2 ** (attempt - 1) if attempt
+           else deadline + GRACE_PERIOD)
+
+    try:
+        added = queue.add(
+            url='/matches/{}/check/'.format(match.pk),
+            name=task_name(match.pk, deadline, attempt),
+            eta=eta,
+            params={'deadline': deadline_token(deadline), 'attempt': attempt},
+        )
+    except Exception as exc:
+        LOGGER.warning('unable to schedule check of match %s', match.pk)
+        LOGGER.warning(exc)
+        return False
+
+    if added:
+        LOGGER.info('scheduled check of match %s at %s', match.pk, eta)
+
+    return added
+
+
+def is_superseded(match, token):
+    '''True if a task for the given deadline token is no longer the match's next deadline'''
+
+    if not token:
+        return False
+
+    deadline = match.deadline_action
+    return not deadline or deadline >= NO_DEADLINE or deadline_token(deadline) != token
+
+
+def schedule_notifications_drain(queue=None, window=2):
+    '''
+    trigger delivery of the notification outbox at the end of the current time window;
+    the task is named after the window, so all notifications in it share one drain
+    '''
+
+    queue = queue or get_task_queue(settings.NOTIFICATIONS_QUEUE)
+    window_end = (int(time.time()) // window + 1) * window
+
+    try:
+        return queue.add(
+            url='/notifications/drain/',
+            name='drain-notifications-{}'.format(window_end),
+            eta=datetime.fromtimestamp(window_end, timezone.utc),
+        )
+    except Exception as exc:
+        LOGGER.warning('unable to schedule delivery of notifications')
+        LOGGER.warning(exc)
+        return False
+
+
+def schedule_avatar(player_pk, queue=None, window=60 * 60):
+    '''
+    resolve the player's avatar in the background; the task is named after
+    player and time window, so repeated saves of a player share one task
+    '''
+
+    if not player_pk:
+        return False
+
+    queue = queue or get_task_queue(settings.AVATARS_QUEUE)
+    window_start = int(time.time()) // window * window
+
+    try:
+        return queue.add(
+            url='/players/avatars/',
+            name='avatar-{}-{}'.format(player_pk, window_start),
+            params={'pk': player_pk},
+        )
+    except Exception as exc:
+        LOGGER.warning('unable to schedule avatar of player %s', player_pk)
+        LOGGER.warning(exc)
+        return False
+
+
+def schedule_variants(image_pk, queue=None):
+    '''create the image's variants in the background, once per image'''
+
+    if not image_pk:
+        return False
+
+    queue = queue or get_task_queue(settings.IMAGES_QUEUE)
+
+    try:
+        return queue.add(
+            url='/images/{}/variants/'.format(image_pk),
+            name='variants-{}'.format(image_pk),
+        )
+    except Exception as exc:
+        LOGGER.warning('unable to schedule variants of image %s', image_pk)
+        LOGGER.warning(exc)
+        return False
+
+
+def schedule_image_pool(queue=None, window=60 * 10):
+    '''
+    rebuild the image pool with a scan of all public images in the background;
+    the task is named after the time window, so concurrent rebuilds share one scan
+    '''
+
+    queue = queue or get_task_queue(settings.IMAGES_QUEUE)
+    window_start = int(time.time()) // window * window
+
+    try:
+        return queue.add(
+            url='/images/pool/',
+            name='image-pool-{}'.format(window_start),
+        )
+    except Exception as exc:
+        LOGGER.warning('unable to schedule a scan of the image pool')
+        LOGGER.warning(exc)
+        return False
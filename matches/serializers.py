@@ -5,6 +5,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
 
 import logging
+import random
 import re
 
 # pylint: disable=redefined-builtin
@@ -12,19 +13,25 @@ from builtins import str, zip
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 # from rest_framework.validators import UniqueValidator
-from django.utils.crypto import random
+from django.conf import settings
+from django.core.cache import cache
 from djangae.contrib.gauth_datastore.models import GaeDatastoreUser
 
+from .authentication import invalidate_credentials
 from .models import (
-    Match, Player, Image, MessageGroup,
+    PLAYER_PROFILES, ChatMessage, Match, Player, Image, MessageGroup,
     MatchDetailsSerializer, RoundSerializer, MessageSerializer)
+from .scheduler import deadline_token
 
 LOGGER = logging.getLogger(__name__)
+# seconds a rendered match stays cached, every save renders a new version anyway
+RENDER_TIMEOUT = 60 * 60
 
 
 class ImageSerializer(serializers.ModelSerializer):
     url = serializers.URLField(required=False, read_only=True)
     info = serializers.DictField(required=False)
+    variants = serializers.SerializerMethodField()
 
     def __init__(self, player=None, *args, **kwargs):
         super(ImageSerializer, self).__init__(*args, **kwargs)
@@ -35,6 +42,7 @@ class ImageSerializer(serializers.ModelSerializer):
         fields = (
             'pk',
             'url',
+            'variants',
             'width',
             'height',
             'size',
@@ -55,6 +63,13 @@ class ImageSerializer(serializers.ModelSerializer):
             'last_modified',
         )
 
+    # pylint: disable=no-self-use
+    def get_variants(self, obj):
+        '''url, width and height of each variant created so far'''
+
+        return {name: {key: variant.get(key) for key in ('url', 'width', 'height')}
+                for name, variant in (obj.variants or {}).items()}
+
     def to_representation(self, obj):
         data = super(ImageSerializer, self).to_representation(obj)
 
@@ -71,6 +86,61 @@ class ImageSerializer(serializers.ModelSerializer):
         return data
 
 
+def shuffled(items, *seed):
+    '''
+    the items in an order that is random, but the same for the same seed,
+    so every render of one version of a match shows the images alike
+    '''
+
+    items = sorted(items)
+    seed = '-'.join(str(part) for part in (settings.SECRET_KEY,) + seed)
+    random.Random(seed).shuffle(items)
+    return items
+
+
+def render_key(match, player_pk=None):
+    '''
+    cache key of a match's representation for a viewer; all non-players see
+    the same masking, so they share one entry per version
+    '''
+
+    if not match.pk or not match.last_modified:
+        return None
+
+    # pylint: disable=no-member
+    role = 'player' if player_pk and player_pk in (match.players_ids or ()) else 'outsider'
+    return 'match-render-{}-{}-{}-{}'.format(
+        match.pk, deadline_token(match.last_modified),
+        role, player_pk if role == 'player' else '')
+
+
+class MatchListSerializer(serializers.ListSerializer):
+    '''looks up all cached representations of a page with one cache read'''
+
+    def to_representation(self, data):
+        matches = list(data.all() if hasattr(data, 'all') else data)
+        viewing_player = self.child.player.pk if self.child.player else None
+
+        keys = [render_key(match, viewing_player) for match in matches]
+        cached = cache.get_many([key for key in keys if key])
+
+        result = []
+        to_cache = {}
+
+        for match, key in zip(matches, keys):
+            rendered = cached.get(key) if key else None
+            if rendered is None:
+                rendered = self.child.render(match)
+                if key:
+                    to_cache[key] = rendered
+            result.append(rendered)
+
+        if to_cache:
+            cache.set_many(to_cache, RENDER_TIMEOUT)
+
+        return result
+
+
 class MatchSerializer(serializers.ModelSerializer):
     # pylint: disable=no-member
     players = serializers.PrimaryKeyRelatedField(queryset=Player.objects.all(), many=True)
@@ -116,12 +186,28 @@ class MatchSerializer(serializers.ModelSerializer):
             'last_modified',
             'finished',
         )
+        list_serializer_class = MatchListSerializer
 
     def to_representation(self, obj):
+        key = render_key(obj, self.player.pk if self.player else None)
+        data = cache.get(key) if key else None
+
+        if data is None:
+            data = self.render(obj)
+            if key:
+                cache.set(key, data, RENDER_TIMEOUT)
+
+        return data
+
+    def render(self, obj):
+        '''the representation masked for the viewing player'''
+
         data = super(MatchSerializer, self).to_representation(obj)
 
         all_images = set()
         viewing_player = self.player.pk if self.player else None
+        version = '{}-{}'.format(
+            obj.pk, deadline_token(obj.last_modified) if obj.last_modified else '')
 
         for round_data, round_obj in zip(data['rounds'], obj.rounds_list):
             assert round_data['number'] == round_obj.number
@@ -142,15 +228,12 @@ class MatchSerializer(serializers.ModelSerializer):
                     details_data['vote_player'] = bool(details_data.get('vote_player'))
 
             if round_obj.display_images_to(player_pk=viewing_player):
-                random.shuffle(images)
-                round_data['images'] = images
+                round_data['images'] = shuffled(images, version, round_obj.number)
                 all_images.update(images)
             else:
                 round_data['images'] = None
 
-        all_images = list(all_images)
-        random.shuffle(all_images)
-        data['images'] = all_images
+        data['images'] = shuffled(all_images, version)
 
         return data
 
@@ -209,6 +292,7 @@ class PlayerSerializer(serializers.ModelSerializer):
             'last_modified',
         )
         read_only_fields = (
+            'total_matches',
             'created',
             'last_modified',
         )
@@ -244,6 +328,7 @@ class PlayerSerializer(serializers.ModelSerializer):
         user_data = validated_data.pop('user', None)
         if user_data:
             user = instance.user
+            old_username = user.username
             users = GaeDatastoreUser.objects.exclude(pk=user.pk)
 
             username = user_data.get('username')
@@ -268,6 +353,10 @@ class PlayerSerializer(serializers.ModelSerializer):
 
                 user.set_password(password)
 
+            if password or user.username != old_username:
+                # verified credentials are cached per username and password
+                invalidate_credentials(user, username=old_username)
+
             user.save()
 
         instance.avatar = validated_data.get('avatar') or instance.avatar
@@ -275,6 +364,9 @@ class PlayerSerializer(serializers.ModelSerializer):
                                         or instance.gcm_registration_id)
         instance.save()
 
+        # username and avatar are shown in notifications and chat
+        PLAYER_PROFILES.invalidate([instance.pk])
+
         return instance
 
 
@@ -295,3 +387,13 @@ class MessageGroupSerializer(serializers.ModelSerializer):
             'created',
             'last_modified',
         )
+
+
+class ChatMessageSerializer(serializers.ModelSerializer):
+    class Meta(object):
+        model = ChatMessage
+        fields = (
+            'player',
+            'text',
+            'timestamp',
+        )
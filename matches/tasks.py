@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+'''push task queues'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import logging
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+LOGGER = logging.getLogger(__name__)
+
+_QUEUES = {}
+_QUEUES_LOCK = threading.Lock()
+
+
+class TaskQueue(object):
+    '''adds push tasks to an App Engine task queue'''
+
+    def __init__(self, queue_name='default'):
+        self.queue_name = queue_name
+
+    def add(self, url, name=None, eta=None, params=None, method='POST'):
+        '''add a task, return False if a task with that name exists or existed before'''
+
+        # pylint: disable=import-error
+        from google.appengine.api import taskqueue
+
+        task = taskqueue.Task(url=url, name=name, eta=eta, params=params, method=method)
+
+        try:
+            taskqueue.Queue(self.queue_name).add(task)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            LOGGER.debug('task <%s> already exists in queue <%s>', name, self.queue_name)
+            return False
+
+        return True
+
+
+class LocalTaskQueue(object):
+    '''
+    in-process stand-in for the task queue with the same naming semantics; due
+    tasks are executed by calling run_due, by default through the Django test client
+    '''
+
+    def __init__(self, queue_name='default', handler=None):
+        self.queue_name = queue_name
+        self.handler = handler
+        self.tasks = []
+        self.names = set()
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def add(self, url, name=None, eta=None, params=None, method='POST'):
+        with self.lock:
+            if name and name in self.names:
+                return False
+
+            self.counter += 1
+            name = name or 'task-{}'.format(self.counter)
+            self.names.add(name)
+            self.tasks.append({
+                'name': name,
+                'url': url,
+                'eta': eta or timezone.now(),
+                'params': params or {},
+                'method': method,
+            })
+
+        return True
+
+    def due(self, now=None):
+        now = now or timezone.now()
+        with self.lock:
+            return sorted((task for task in self.tasks if task['eta'] <= now),
+                          key=lambda task: task['eta'])
+
+    def run_due(self, now=None):
+        '''execute all tasks that are due and return them with their responses'''
+
+        result = []
+
+        for task in self.due(now):
+            with self.lock:
+                self.tasks.remove(task)
+            # names stay taken like tombstoned tasks on App Engine
+            result.append((task, self.execute(task)))
+
+        return result
+
+    def execute(self, task):
+        if self.handler is not None:
+            return self.handler(task)
+
+        from django.test import Client
+
+        client = Client()
+        request = client.post if task['method'] == 'POST' else client.get
+        return request(task['url'], task['params'], HTTP_X_APPENGINE_QUEUENAME=self.queue_name)
+
+
+def get_task_queue(queue_name='default'):
+    '''shared task queue instance of the class configured in TASK_QUEUE_CLASS'''
+
+    with _QUEUES_LOCK:
+        queue = _QUEUES.get(queue_name)
+        if queue is None:
+            queue_class = import_string(getattr(settings, 'TASK_QUEUE_CLASS',
+                                                'matches.tasks.TaskQueue'))
+            queue = _QUEUES[queue_name] = queue_class(queue_name)
+        return queue
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+'''
+signed direct-to-storage uploads: the client gets an expiring upload target,
+puts the image straight into the bucket and finalizes the upload with a token
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
+
+import logging
+import os
+import os.path
+import threading
+import time
+
+from base64 import b64encode
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from six.moves.urllib.parse import quote, urlencode
+
+from .utils import random_string
+
+LOGGER = logging.getLogger(__name__)
+
+BUCKET = 'diris-app.appspot.com'
+GCS_URL = 'https://storage.googleapis.com'
+# seconds an upload target and its finalize token are valid
+UPLOAD_EXPIRATION = 15 * 60
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024
+SIGNING_SALT = 'matches.uploads'
+# same layout as Image.file's upload_to
+UPLOAD_PATH = '%Y/%m/%d/%H/%M/'
+
+_STORAGE = None
+_STORAGE_LOCK = threading.Lock()
+
+
+class UploadNotFound(Exception):
+    '''the client hasn't uploaded the object (yet)'''
+
+
+def object_name(file_extension=None):
+    return '{}{}{}'.format(timezone.now().strftime(UPLOAD_PATH), random_string(),
+                           file_extension or '.jpeg')
+
+
+def sign_token(data):
+    return signing.dumps(data, salt=SIGNING_SALT)
+
+
+def load_token(token, expiration=UPLOAD_EXPIRATION):
+    '''the data of a finalize token, raises signing.BadSignature if invalid or expired'''
+
+    return signing.loads(token, salt=SIGNING_SALT, max_age=expiration)
+
+
+class CloudStorageUploads(object):
+    '''upload targets as V2 signed URLs for a Cloud Storage bucket'''
+
+    def __init__(self, bucket=BUCKET):
+        self.bucket = bucket
+
+    def path(self, name):
+        return '/{}/{}'.format(self.bucket, name)
+
+    def target(self, name, content_type, expiration=UPLOAD_EXPIRATION):
+        '''where and how the client puts the object'''
+
+        # pylint: disable=import-error
+        from google.appengine.api import app_identity
+
+        expires = int(time.time()) + expiration
+        to_sign = '\n'.join(('PUT', '', content_type, str(expires),
+                             'x-goog-acl:public-read', self.path(name)))
+        _, signature = app_identity.sign_blob(to_sign.encode('utf-8'))
+
+        query = urlencode({
+            'GoogleAccessId': app_identity.get_service_account_name(),
+            'Expires': expires,
+            'Signature': b64encode(signature),
+        })
+
+        return {
+            'url': '{}{}?{}'.format(GCS_URL, quote(self.path(name)), query),
+            'method': 'PUT',
+            'headers': {'Content-Type': content_type, 'x-goog-acl': 'public-read'},
+            'expires': expires,
+        }
+
+    def size(self, name):
+        # pylint: disable=import-error
+        import cloudstorage
+
+        try:
+            return cloudstorage.stat(self.path(name)).st_size
+        except cloudstorage.NotFoundError as exc:
+            raise UploadNotFound(str(exc))
+
+    def open(self, name):
+        # pylint: disable=import-error
+        import cloudstorage
+
+        return cloudstorage.open(self.path(name), mode='r')
+
+    def delete(self, name):
+        # pylint: disable=import-error
+        import cloudstorage
+
+        try:
+            cloudstorage.delete(self.path(name))
+        except cloudstorage.NotFoundError:
+            pass
+
+
+class LocalUploads(object):
+    '''
+    filesystem stand-in for the bucket, for tests and the development server;
+    the upload target is LocalUploadView, which checks the token in the URL
+    '''
+
+    def __init__(self, root=None, base_url='/upload/local/'):
+        self.root = root or os.path.join(settings.BASE_DIR, '.uploads')
+        self.base_url = base_url
+
+    def path(self, name):
+        path = os.path.normpath(os.path.join(self.root, name))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError('invalid object name "{}"'.format(name))
+        return path
+
+    def target(self, name, content_type, expiration=UPLOAD_EXPIRATION):
+        token = sign_token({'name': name, 'content_type': content_type})
+        return {
+            'url': '{}{}?{}'.format(self.base_url, quote(name), urlencode({'token': token})),
+            'method': 'PUT',
+            'headers': {'Content-Type': content_type},
+            'expires': int(time.time()) + expiration,
+        }
+
+    def save(self, name, content):
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as file:
+            file.write(content)
+
+    def size(self, name):
+        try:
+            return os.path.getsize(self.path(name))
+        except OSError as exc:
+            raise UploadNotFound(str(exc))
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+
+def get_upload_storage():
+    '''shared instance of the class configured in UPLOAD_STORAGE_CLASS'''
+
+    global _STORAGE  # pylint: disable=global-statement
+
+    with _STORAGE_LOCK:
+        if _STORAGE is None:
+            _STORAGE = import_string(getattr(settings, 'UPLOAD_STORAGE_CLASS',
+                                             'matches.uploads.CloudStorageUploads'))()
+        return _STORAGE
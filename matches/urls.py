@@ -17,7 +17,14 @@ router.register(r'images', views.ImageViewSet, base_name='image')
 
 urlpatterns = [
     url(r'^', include(router.urls)),
+    url(r'^upload/sign/?$', views.SignedUploadView.as_view()),
+    url(r'^upload/finalize/?$', views.FinalizeUploadView.as_view()),
+    url(r'^upload/local/(?P<name>.+)$', views.LocalUploadView.as_view()),
     url(r'^upload/(?P<filename>[^/]+)/?$', views.ImageUploadView.as_view()),
+    url(r'^notifications/drain/?$', views.NotificationDrainView.as_view()),
+    url(r'^notifications/purge/?$', views.NotificationPurgeView.as_view()),
+    url(r'^stats/?$', views.StatsView.as_view()),
+    url(r'^stats/profile/?$', views.ProfileView.as_view()),
     url(r'^matches/(?P<match_pk>[^/]+)/(?P<round_number>[^/]+)/image/(?P<filename>[^/]+)/?$',
         views.MatchImageView.as_view()),
     url(r'^matches/(?P<match_pk>[^/]+)/(?P<round_number>[^/]+)/vote/(?P<image_pk>[^/]+)/?$',
@@ -4,19 +4,25 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
 
+import base64
 import hashlib
+import json
 import logging
 import string
+import threading
 
 # pylint: disable=redefined-builtin
-from builtins import filter, str
+from builtins import filter, range, str
 from collections import OrderedDict
+from datetime import datetime
 
 import six
 
+from django.utils import dateparse, timezone
 from django.utils.crypto import get_random_string, random
 from rest_framework.exceptions import NotAuthenticated
 from rest_framework_jwt.utils import jwt_payload_handler
+from six.moves import queue
 
 LOGGER = logging.getLogger(__name__)
 
@@ -75,6 +81,61 @@ def normalize_space(item, preserve_linebreaks=False):
     return ' '.join(str(item).split())
 
 
+def parse_datetime(value):
+    '''parse an ISO 8601 string (as written by the serializers) into an aware datetime'''
+
+    if not value:
+        return None
+
+    if not isinstance(value, datetime):
+        parsed = dateparse.parse_datetime(value)
+        if parsed is None:
+            raise ValueError('invalid datetime value "{}"'.format(value))
+        value = parsed
+
+    return value if timezone.is_aware(value) else timezone.make_aware(value, timezone.utc)
+
+
+def format_datetime(value):
+    '''format a datetime as ISO 8601 string the same way the serializers do'''
+
+    if value is None:
+        return None
+
+    value = value.isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+
+def encode_cursor(data):
+    '''opaque, URL safe cursor of a dictionary; datetimes are kept as ISO strings'''
+
+    data = {key: format_datetime(value) if isinstance(value, datetime) else value
+            for key, value in six.iteritems(data) if value is not None}
+    data = json.dumps(data, sort_keys=True).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor, datetime_keys=('issued',)):
+    '''the dictionary in a cursor, empty for no cursor; raises ValueError if invalid'''
+
+    if not cursor:
+        return {}
+
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor).encode('ascii')).decode('utf-8'))
+    except Exception as exc:
+        six.raise_from(ValueError('invalid cursor "{}"'.format(cursor)), exc)
+
+    if not isinstance(data, dict):
+        raise ValueError('invalid cursor "{}"'.format(cursor))
+
+    for key in datetime_keys:
+        if data.get(key):
+            data[key] = parse_datetime(data[key])
+
+    return data
+
+
 def jwt_payload(user):
     payload = jwt_payload_handler(user)
     payload['pk'] = user.player.pk
@@ -83,9 +144,10 @@ def jwt_payload(user):
 
 
 def find_current_round(match):
-    for round_ in match.rounds_list:
-        if round_.is_current_round:
-            return round_.number
+    # read the stored data so computing the field does not decode any rounds
+    for data in match.rounds or ():
+        if data.get('is_current_round'):
+            return data['number']
 
     return match.total_rounds if match.status == 'f' else 1
 
@@ -98,6 +160,89 @@ def get_player(request, raise_error=False):
             six.raise_from(NotAuthenticated(detail='no user'), exc)
 
 
+def chunks(items, size):
+    '''split a list into consecutive chunks of at most the given size'''
+
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)] if size > 0 else [items]
+
+
+def run_in_pool(func, items, workers=4):
+    '''
+    call func on every item with a bounded pool of threads; returns the results in
+    order of the items, with the exception in place of the result if a call failed
+    '''
+
+    items = list(items)
+    results = [None] * len(items)
+    tasks = queue.Queue()
+
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as exc:
+                LOGGER.exception(exc)
+                results[index] = exc
+
+    threads = [threading.Thread(target=worker) for _ in range(max(min(workers, len(items)), 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def bulk_save(instances, batch_size=500):
+    '''
+    write model instances with multi-entity datastore puts; like a raw save this
+    neither calls save() nor sends signals, but fields' pre_save hooks still run
+    '''
+
+    # pylint: disable=import-error
+    from django.db import connections, router
+    from djangae.db.backends.appengine import caching
+    from djangae.db.utils import django_instance_to_entity
+    from google.appengine.api import datastore
+
+    instances = [instance for instance in instances if instance is not None]
+
+    for batch in chunks(instances, batch_size):
+        entities = []
+        namespaces = set()
+
+        for instance in batch:
+            model = type(instance)
+            connection = connections[router.db_for_write(model, instance=instance)]
+            namespaces.add(connection.settings_dict.get('NAMESPACE'))
+            entities.append(django_instance_to_entity(
+                connection, model, model._meta.concrete_fields, False, instance))
+
+        if not entities:
+            continue
+
+        keys = datastore.Put(entities)
+
+        for namespace in namespaces:
+            try:
+                caching.remove_entities_from_cache_by_key(keys, namespace)
+            except Exception as exc:
+                LOGGER.warning(exc)
+
+        for instance in batch:
+            instance._state.adding = False
+
+    return len(instances)
+
+
 def calculate_id(ids, bits=None):
     id_str = ','.join(map(str, sorted(ids)))
     sha = hashlib.sha256(id_str).hexdigest()
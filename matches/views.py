@@ -4,20 +4,23 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals, with_statement
 
+import hashlib
 import json
 import logging
 import os.path
+import time
 
 from base64 import b64decode
+from datetime import timedelta
 
 # pylint: disable=redefined-builtin
 from builtins import str
 from django.conf import settings
 from django.contrib.auth import login
-from django.db.models import Q
-from django.utils.crypto import get_random_string, random
+from django.core import signing
+from django.utils import timezone
+from django.utils.crypto import get_random_string
 from djangae.contrib.gauth_datastore.models import GaeDatastoreUser
-from djangae.contrib.pagination import Paginator
 # pylint: disable=import-error
 from google.appengine.api.mail import send_mail
 from rest_framework import mixins, permissions, status, views, viewsets
@@ -28,15 +31,29 @@ from rest_framework.parsers import FileUploadParser, MultiPartParser
 from rest_framework_jwt.settings import api_settings
 from six import itervalues, raise_from, string_types
 
-from .models import Image, Match, Player, MessageGroup
-from .permissions import IsOwnerOrCreateAndRead
-from .serializers import MatchSerializer, PlayerSerializer, ImageSerializer, MessageGroupSerializer
-from .utils import calculate_id, get_player, merge, normalize_space, random_string
+from .authentication import invalidate_credentials
+from .conditional import make_etag, not_modified, set_validators, stats as conditional_stats
+from .models import (
+    AVATAR_FETCHER, IMAGE_DEDUPE, IMAGE_POOL, PUBSUB_SENDER,
+    ChatHead, ChatMessage, Image, Match, MatchTombstone, Player, MessageGroup, Notification)
+from .permissions import IsOwnerOrCreateAndRead, IsTaskOrAdmin
+from .profiling import PROFILER
+from .scheduler import is_superseded, schedule_match
+from .serializers import (
+    ChatMessageSerializer, ImageSerializer, MatchSerializer,
+    MessageGroupSerializer, PlayerSerializer)
+from .tasks import get_task_queue
+from .uploads import (
+    MAX_UPLOAD_SIZE, LocalUploads, UploadNotFound,
+    get_upload_storage, load_token, object_name, sign_token)
+from .utils import (
+    calculate_id, chunks, decode_cursor, encode_cursor, get_player,
+    merge, normalize_space, parse_datetime, random_string, run_in_pool)
 
 LOGGER = logging.getLogger(__name__)
 
 
-def upload_image(request, owner=None, file_extension=None):
+def upload_image(request, owner=None, file_extension=None, exclude=()):
     image = request.data['file']
     orig_extension = (os.path.splitext(image.name)[1]
                       if hasattr(image, 'name') and isinstance(image.name, string_types)
@@ -44,6 +61,15 @@ def upload_image(request, owner=None, file_extension=None):
     file_extension = file_extension or orig_extension or '.jpeg'
     image.name = random_string() + file_extension
 
+    copyright, info = image_options(request, owner)
+
+    return Image.objects.create_image(
+        file=image, owner=owner, copyright=copyright, info=info, exclude=exclude)
+
+
+def image_options(request, owner=None):
+    '''copyright and info of an uploaded image from body and query'''
+
     copyright = (normalize_space(request.data.get('copyright'))
                  or normalize_space(request.query_params.get('copyright')))
     if copyright not in {c[0] for c in Image.COPYRIGHTS}:
@@ -57,7 +83,7 @@ def upload_image(request, owner=None, file_extension=None):
 
     info = merge(request.query_params or {}, body_info)
 
-    return Image.objects.create_image(file=image, owner=owner, copyright=copyright, info=info)
+    return copyright, info
 
 
 class MatchViewSet(
@@ -72,10 +98,19 @@ class MatchViewSet(
     filter_fields = ('inviting_player', 'status')
 
     default_checks_size = 100
+    max_checks_shards = 16
+    max_checks_workers = 8
+
+    default_sync_size = 50
+    max_sync_size = 100
+    default_chat_size = 50
+    max_chat_size = 100
+    sync_settle_time = timedelta(seconds=10)
 
     def get_queryset(self):
         player = get_player(self.request)
-        return player.matches.all() if player else Match.objects.none()
+        # pylint: disable=no-member
+        return Match.objects.for_player(player.pk) if player else Match.objects.none()
 
     # pylint: disable=unused-argument
     def create(self, request, *args, **kwargs):
@@ -92,8 +127,15 @@ class MatchViewSet(
         player = get_player(request, raise_error=True)
 
         match = self.get_object()
+
+        # the representation is masked per viewer, so the viewer is part of the validator
+        etag = make_etag('match', match.pk, match.last_modified, player.pk)
+        response = not_modified(request, 'match', etag, match.last_modified)
+        if response is not None:
+            return response
+
         serializer = self.get_serializer(instance=match, player=player)
-        return Response(serializer.data)
+        return set_validators(Response(serializer.data), etag, match.last_modified)
 
     # pylint: disable=unused-argument
     def list(self, request, *args, **kwargs):
@@ -102,12 +144,20 @@ class MatchViewSet(
         matches = self.filter_queryset(self.get_queryset()).order_by(*self.ordering)
 
         page = self.paginate_queryset(matches)
-        if page is not None:
-            serializer = self.get_serializer(instance=page, player=player, many=True)
-            return self.get_paginated_response(serializer.data)
+        items = list(page if page is not None else matches)
 
-        serializer = self.get_serializer(instance=matches, player=player, many=True)
-        return Response(serializer.data)
+        last_modified = max([match.last_modified for match in items if match.last_modified]
+                            or [None])
+        etag = make_etag('matches', player.pk, request.get_full_path(),
+                         *('{}:{}'.format(match.pk, match.last_modified) for match in items))
+        response = not_modified(request, 'matches', etag, last_modified)
+        if response is not None:
+            return response
+
+        serializer = self.get_serializer(instance=items, player=player, many=True)
+        response = (self.get_paginated_response(serializer.data) if page is not None
+                    else Response(serializer.data))
+        return set_validators(response, etag, last_modified)
 
     @list_route(methods=['get', 'post'], permission_classes=())
     # pylint: disable=unused-argument
@@ -121,13 +171,66 @@ class MatchViewSet(
         except (TypeError, ValueError):
             size = self.default_checks_size
 
+        try:
+            shards = min(int(request.query_params.get('shards')), self.max_checks_shards)
+        except (TypeError, ValueError):
+            shards = 0
+
+        if shards > 0:
+            return self._sharded_checks(request, matches, size, shards)
+
         for match in matches[:size]:
             match.check_status()
             match.score()
             match.save()
+            # safety net in case a scheduled check got lost
+            schedule_match(match)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def _sharded_checks(self, request, matches, size, shards):
+        '''
+        split the deadline ordered matches into consecutive shards, check the shards
+        concurrently and write the changed matches with batch puts per shard
+        '''
+
+        try:
+            workers = min(int(request.query_params.get('workers')), self.max_checks_workers)
+        except (TypeError, ValueError):
+            workers = shards
+        workers = max(min(workers, self.max_checks_workers), 1)
+
+        stt = time.time()
+        pks = list(matches.values_list('pk', flat=True)[:size])
+        shard_pks = chunks(pks, -(-len(pks) // shards)) if pks else []
+
+        def process(item):
+            index, shard = item
+            shard_stt = time.time()
+            checked, written = Match.objects.check_matches(shard)
+            return {
+                'shard': index,
+                'matches': checked,
+                'written': written,
+                'seconds': round(time.time() - shard_stt, 3),
+            }
+
+        results = run_in_pool(process, enumerate(shard_pks), workers=workers)
+        results = [result if isinstance(result, dict)
+                   else {'shard': index, 'error': str(result)}
+                   for index, result in enumerate(results)]
+
+        for result in results:
+            LOGGER.info('checks shard %s', result)
+
+        return Response({
+            'matches': sum(result.get('matches', 0) for result in results),
+            'written': sum(result.get('written', 0) for result in results),
+            'shards': results,
+            'workers': workers,
+            'seconds': round(time.time() - stt, 3),
+        })
+
     @detail_route(methods=['get', 'post'], permission_classes=())
     # pylint: disable=unused-argument
     def check(self, request, pk=None, *args, **kwargs):
@@ -137,10 +240,27 @@ class MatchViewSet(
         except Match.DoesNotExist as exc:
             raise_from(NotFound(detail='match "{}" does not exist'.format(pk)), exc)
 
+        deadline = request.data.get('deadline') or request.query_params.get('deadline')
+        if is_superseded(match, deadline):
+            LOGGER.info('scheduled check of match %s for deadline %s was superseded',
+                        match.pk, deadline)
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
         match.check_status()
         match.score()
         match.save()
 
+        # the task name of this deadline is used up, so a check that found it still
+        # pending, e.g. because the task ran early, schedules a retry under a new name
+        if (deadline and not is_superseded(match, deadline)
+                and match.status in (Match.WAITING, Match.IN_PROGESS)):
+            try:
+                attempt = int(request.data.get('attempt') or
+                              request.query_params.get('attempt') or 0)
+            except (TypeError, ValueError):
+                attempt = 0
+            schedule_match(match, attempt=attempt + 1)
+
         player = get_player(request)
 
         if player and player.pk in match.players_ids:
@@ -190,6 +310,80 @@ class MatchViewSet(
         serializer = PlayerSerializer(instance=match.players, many=True)
         return Response(serializer.data)
 
+    @list_route()
+    # pylint: disable=unused-argument
+    def sync(self, request, *args, **kwargs):
+        '''
+        the player's matches changed since the cursor and the pks of those deleted
+        since, in the order of their last modification; pass the returned cursor
+        next time and keep asking while more is true, start over if reset is true
+        '''
+
+        player = get_player(request, raise_error=True)
+
+        try:
+            size = min(max(int(request.query_params.get('size')), 1), self.max_sync_size)
+        except (TypeError, ValueError):
+            size = self.default_sync_size
+
+        try:
+            cursor = decode_cursor(request.query_params.get('cursor'))
+        except ValueError as exc:
+            raise_from(ValidationError(detail='invalid cursor'), exc)
+
+        now = timezone.now()
+
+        # older cursors may have missed tombstones that are purged already
+        if cursor.get('issued') and cursor['issued'] < now - MatchTombstone.RETENTION:
+            return Response({'matches': [], 'deleted': [], 'cursor': None,
+                             'more': False, 'reset': True})
+
+        # pylint: disable=no-member
+        matches = Match.objects.for_player(player.pk).order_by('pagination_last_modified')
+        if cursor.get('matches'):
+            matches = matches.filter(pagination_last_modified__gt=cursor['matches'])
+        matches = list(matches[:size + 1])
+
+        tombstones = MatchTombstone.objects.filter(player_pks__contains=player.pk)
+        tombstones = tombstones.order_by('pagination_created')
+        if cursor.get('deleted'):
+            tombstones = tombstones.filter(pagination_created__gt=cursor['deleted'])
+        tombstones = list(tombstones[:size + 1])
+
+        more_matches = len(matches) > size
+        more_tombstones = len(tombstones) > size
+        matches, tombstones = matches[:size], tombstones[:size]
+
+        # queries are eventually consistent, so each cursor stays behind the most recent
+        # changes and those are sent again next time, unless its own page is full
+        settled = now - self.sync_settle_time
+        next_cursor = dict(cursor, issued=now)
+        for match in matches:
+            if more_matches or match.last_modified <= settled:
+                next_cursor['matches'] = match.pagination_last_modified
+        for tombstone in tombstones:
+            if more_tombstones or tombstone.created <= settled:
+                next_cursor['deleted'] = tombstone.pagination_created
+
+        serializer = self.get_serializer(instance=matches, player=player, many=True)
+
+        return Response({
+            'matches': serializer.data,
+            'deleted': [tombstone.match_pk for tombstone in tombstones],
+            'cursor': encode_cursor(next_cursor),
+            'more': more_matches or more_tombstones,
+            'reset': False,
+        })
+
+    @list_route(methods=['get', 'post'], permission_classes=(IsTaskOrAdmin,))
+    # pylint: disable=no-self-use,unused-argument
+    def tombstones(self, request, *args, **kwargs):
+        '''purge tombstones past their retention'''
+
+        # pylint: disable=no-member
+        purged = MatchTombstone.objects.purge(timezone.now() - MatchTombstone.RETENTION)
+        return Response({'purged': purged})
+
     @detail_route()
     # pylint: disable=unused-argument
     def images(self, request, pk=None, *args, **kwargs):
@@ -218,23 +412,114 @@ class MatchViewSet(
         player = get_player(request, raise_error=True)
         match = self.get_object()
 
+        group_id = match.group_id
+        if group_id is None:
+            # pylint: disable=no-member
+            group_id = calculate_id(match.players_ids, bits=63)
+
+        # clients that know the append-only store opt into pages of messages,
+        # all others get the latest messages in the shape of a message group
+        paged = bool(request.query_params.get('paged'))
+
         if request.method == 'POST':
             text = (normalize_space(request.data.get('text'))
                     or normalize_space(request.query_params.get('text')))
 
-            message_group = match.send_chat(player.pk, text)
+            message = match.send_chat(player.pk, text)
 
-            serializer = MessageGroupSerializer(instance=message_group)
-            return Response(serializer.data)
+            if not paged:
+                # pylint: disable=no-member
+                return Response(self._latest_group(ChatHead.objects.get(pk=group_id)))
 
-        group_id = match.group_id
-        if group_id is None:
-            # pylint: disable=no-member
-            group_id = calculate_id(match.players_ids, bits=63)
+            return Response({
+                'group_id': group_id,
+                'messages': ChatMessageSerializer(instance=[message], many=True).data,
+                'cursor': encode_cursor({'after': message.pagination_timestamp}),
+                'more': False,
+                'older': None,
+            })
 
         sequence = (normalize_space(request.data.get('seq'))
                     or normalize_space(request.query_params.get('seq')))
 
+        if sequence:
+            return self._legacy_chat(request, group_id, sequence)
+
+        # pylint: disable=no-member
+        head = ChatHead.objects.filter(pk=group_id).first()
+
+        if head is None and not paged:
+            return self._legacy_chat(request, group_id)
+
+        if head is None or not head.legacy_imported:
+            head = ChatMessage.objects.import_legacy(group_id)
+
+        try:
+            cursor = decode_cursor(request.query_params.get('cursor'))
+            older = decode_cursor(request.query_params.get('older'))
+            since = parse_datetime(request.query_params.get('since'))
+        except ValueError as exc:
+            raise_from(ValidationError(detail=str(exc)), exc)
+
+        try:
+            size = min(max(int(request.query_params.get('size')), 1), self.max_chat_size)
+        except (TypeError, ValueError):
+            size = self.default_chat_size
+
+        # the head changes with every message, so nothing new means a 304 without a query
+        etag = make_etag('chat', group_id, head.last_modified, request.get_full_path())
+        response = not_modified(request, 'chat', etag, head.last_modified)
+        if response is not None:
+            return response
+
+        if not paged:
+            return set_validators(Response(self._latest_group(head)), etag, head.last_modified)
+
+        # pylint: disable=no-member
+        if cursor.get('after') or since:
+            messages, more = ChatMessage.objects.page(
+                group_id, after=cursor.get('after'), since=since, size=size)
+            more_older = False
+        else:
+            # the latest messages, or those before the older cursor
+            messages, more_older = ChatMessage.objects.page(
+                group_id, before=older.get('before'), size=size)
+            more = False
+
+        next_cursor = ({'after': messages[-1].pagination_timestamp} if messages
+                       else cursor)
+        older_cursor = ({'before': messages[0].pagination_timestamp}
+                        if messages and more_older else None)
+
+        response = Response({
+            'group_id': group_id,
+            'messages': ChatMessageSerializer(instance=messages, many=True).data,
+            'cursor': encode_cursor(next_cursor) if next_cursor else None,
+            'more': more,
+            'older': encode_cursor(older_cursor) if older_cursor else None,
+        })
+        return set_validators(response, etag, head.last_modified)
+
+    # pylint: disable=no-self-use
+    def _latest_group(self, head):
+        '''the latest messages of the chat in the shape of a legacy message group'''
+
+        # pylint: disable=no-member
+        messages, _ = ChatMessage.objects.page(head.group_id, size=MessageGroup.MAX_SIZE)
+        return {
+            'pk': head.group_id,
+            'group_id': head.group_id,
+            # one after the last legacy group, whose messages are the older ones
+            'sequence': 0 if head.legacy_sequence is None else head.legacy_sequence + 1,
+            'messages': ChatMessageSerializer(instance=messages, many=True).data,
+            'created': messages[0].timestamp if messages else head.last_modified,
+            'last_modified': head.last_modified,
+        }
+
+    # pylint: disable=no-self-use
+    def _legacy_chat(self, request, group_id, sequence=None):
+        '''chats written before the append-only store, as whole message groups'''
+
         # pylint: disable=no-member
         queryset = MessageGroup.objects.filter(group_id=group_id)
         queryset = (queryset.filter(sequence=int(sequence)) if sequence
@@ -244,8 +529,13 @@ class MatchViewSet(
         if message_group is None:
             return Response(status=status.HTTP_204_NO_CONTENT)
 
+        etag = make_etag('chat', message_group.pk, message_group.last_modified)
+        response = not_modified(request, 'chat', etag, message_group.last_modified)
+        if response is not None:
+            return response
+
         serializer = MessageGroupSerializer(instance=message_group)
-        return Response(serializer.data)
+        return set_validators(Response(serializer.data), etag, message_group.last_modified)
 
 
 class MatchImageView(views.APIView):
@@ -255,12 +545,15 @@ class MatchImageView(views.APIView):
     # pylint: disable=no-self-use
     def post(self, request, match_pk, round_number, filename):
         player = get_player(request, raise_error=True)
-        match = player.matches.get(pk=match_pk)
+        # pylint: disable=no-member
+        match = Match.objects.for_player(player.pk).get(pk=match_pk)
         round_ = match.rounds_list[int(round_number) - 1]
 
         file_extension = (os.path.splitext(filename)[1] if isinstance(filename, string_types)
                           else None)
-        image = upload_image(request, player, file_extension)
+        # other players' images in the round are never shared with this upload
+        image = upload_image(request, player, file_extension,
+                             exclude=round_.image_pks(exclude_player=player.pk))
 
         story = (normalize_space(request.data.get('story'))
                  or normalize_space(request.query_params.get('story')))
@@ -283,7 +576,8 @@ class MatchVoteView(views.APIView):
     # pylint: disable=no-self-use
     def post(self, request, match_pk, round_number, image_pk):
         player = get_player(request, raise_error=True)
-        match = player.matches.get(pk=match_pk)
+        # pylint: disable=no-member
+        match = Match.objects.for_player(player.pk).get(pk=match_pk)
         round_ = match.rounds_list[int(round_number) - 1]
 
         try:
@@ -299,6 +593,47 @@ class MatchVoteView(views.APIView):
         return Response(serializer.data)
 
 
+class NotificationDrainView(views.APIView):
+    permission_classes = (IsTaskOrAdmin,)
+
+    default_drain_size = 100
+    max_drain_size = 500
+
+    # pylint: disable=no-self-use,unused-argument
+    def post(self, request, *args, **kwargs):
+        try:
+            size = int(request.query_params.get('size'))
+            size = min(size, self.max_drain_size) if size > 0 else self.default_drain_size
+        except (TypeError, ValueError):
+            size = self.default_drain_size
+
+        # pylint: disable=no-member
+        processed, delivered = Notification.objects.drain(limit=size)
+        return Response({
+            'notifications': processed,
+            'delivered': delivered,
+            'pubsub': PUBSUB_SENDER.stats,
+        })
+
+    def get(self, request, *args, **kwargs):
+        return self.post(request, *args, **kwargs)
+
+
+class NotificationPurgeView(views.APIView):
+    permission_classes = (IsTaskOrAdmin,)
+
+    # pylint: disable=no-self-use,unused-argument
+    def post(self, request, *args, **kwargs):
+        '''purge delivered and failed notifications past their retention'''
+
+        # pylint: disable=no-member
+        purged = Notification.objects.purge(timezone.now() - Notification.RETENTION)
+        return Response({'purged': purged})
+
+    def get(self, request, *args, **kwargs):
+        return self.post(request, *args, **kwargs)
+
+
 class PlayerViewSet(viewsets.ModelViewSet):
     # pylint: disable=no-member
     queryset = Player.objects.all()
@@ -306,6 +641,12 @@ class PlayerViewSet(viewsets.ModelViewSet):
     serializer_class = PlayerSerializer
     ordering = ('-last_modified',)
 
+    default_reconcile_size = 500
+    max_reconcile_size = 1000
+    max_reconcile_shards = 16
+    default_avatars_size = 20
+    max_avatars_size = 100
+
     # pylint: disable=unused-argument
     def create(self, request, *args, **kwargs):
         response = super(PlayerViewSet, self).create(request, *args, **kwargs)
@@ -313,7 +654,9 @@ class PlayerViewSet(viewsets.ModelViewSet):
         player = response.data
         user = GaeDatastoreUser.objects.get(pk=player['user']['pk'])
         user.backend = 'django.contrib.auth.backends.ModelBackend'
-        login(request, user)
+        # token authenticated API calls have no session, see BrowserMiddleware
+        if hasattr(request, 'session'):
+            login(request, user)
 
         jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
         jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
@@ -362,12 +705,121 @@ class PlayerViewSet(viewsets.ModelViewSet):
         LOGGER.info(data)
 
         # pylint: disable=no-member
-        for player in Player.objects.filter(pk__in=player_pks):
-            LOGGER.info(player.pk)
-            LOGGER.info(player.send_message(**data))
+        players = list(Player.objects.filter(pk__in=player_pks)) if player_pks else []
+        Player.objects.send_messages(players, **data)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @list_route(methods=['get', 'post'], permission_classes=(IsTaskOrAdmin,))
+    # pylint: disable=unused-argument
+    def reconcile(self, request, *args, **kwargs):
+        '''
+        recount total_matches for the next page of players after the start cursor,
+        split into concurrent shards, and chain a task for the page after that
+        '''
+
+        params = merge(request.query_params.dict(), request.data)
+
+        try:
+            size = int(params.get('size'))
+            size = (min(size, self.max_reconcile_size) if size > 0
+                    else self.default_reconcile_size)
+        except (TypeError, ValueError):
+            size = self.default_reconcile_size
+
+        try:
+            shards = max(min(int(params.get('shards')), self.max_reconcile_shards), 1)
+        except (TypeError, ValueError):
+            shards = 1
+
+        players = Player.objects.order_by('pk')
+        start = params.get('start')
+        if start:
+            players = players.filter(pk__gt=start)
+
+        stt = time.time()
+        pks = list(players.values_list('pk', flat=True)[:size])
+        shard_pks = chunks(pks, -(-len(pks) // shards)) if pks else []
+
+        results = run_in_pool(Player.objects.reconcile_total_matches, shard_pks, workers=shards)
+        results = [result if isinstance(result, dict) else {'error': str(result)}
+                   for result in results]
+
+        drifts = {}
+        for result in results:
+            drifts.update(result.get('drifts') or {})
+
+        cursor = pks[-1] if len(pks) >= size else None
+
+        if cursor and params.get('chain'):
+            # tasks are named after run and cursor, so a retried page doesn't fork the chain
+            run = params.get('run') or int(stt)
+            get_task_queue(settings.RECONCILE_QUEUE).add(
+                url='/players/reconcile/',
+                name='reconcile-players-{}-{}'.format(run, cursor),
+                params={'size': size, 'shards': shards, 'start': cursor, 'chain': 1, 'run': run},
+            )
+
+        LOGGER.info('reconciled %d players, %d drifted', len(pks), len(drifts))
+
+        return Response({
+            'players': len(pks),
+            'drifted': len(drifts),
+            'drifts': drifts,
+            'errors': [result['error'] for result in results if 'error' in result],
+            'next': cursor,
+            'seconds': round(time.time() - stt, 3),
+        })
+
+    @list_route(methods=['get', 'post'], permission_classes=(IsTaskOrAdmin,))
+    # pylint: disable=unused-argument
+    def avatars(self, request, *args, **kwargs):
+        '''
+        resolve avatars of the given players or, as a backfill, of the next page of
+        players after the start cursor and chain a task for the page after that
+        '''
+
+        params = merge(request.query_params.dict(), request.data)
+
+        try:
+            size = min(max(int(params.get('size')), 1), self.max_avatars_size)
+        except (TypeError, ValueError):
+            size = self.default_avatars_size
+
+        pks = request.data.getlist('pk') if hasattr(request.data, 'getlist') else None
+        pks = (pks or request.query_params.getlist('pk'))[:self.max_avatars_size]
+        cursor = None
+
+        if not pks:
+            # players with an avatar are skipped by resolve_avatars, so no index is needed
+            # pylint: disable=no-member
+            players = Player.objects.order_by('pk')
+            if params.get('start'):
+                players = players.filter(pk__gt=params['start'])
+            pks = list(players.values_list('pk', flat=True)[:size])
+            cursor = pks[-1] if len(pks) >= size else None
+
+        stt = time.time()
+        # pylint: disable=no-member
+        result = Player.objects.resolve_avatars([int(pk) for pk in pks])
+
+        if cursor and params.get('chain'):
+            # tasks are named after run and cursor, so a retried page doesn't fork the chain
+            run = params.get('run') or int(stt)
+            get_task_queue(settings.AVATARS_QUEUE).add(
+                url='/players/avatars/',
+                name='avatars-players-{}-{}'.format(run, cursor),
+                params={'size': size, 'start': cursor, 'chain': 1, 'run': run},
+            )
+
+        result['next'] = cursor
+        result['seconds'] = round(time.time() - stt, 3)
+        result['fetcher'] = AVATAR_FETCHER.stats
+
+        LOGGER.info('avatars %s', result)
+
+        return Response(result)
+
     @list_route(methods=['post'], permission_classes=())
     # pylint: disable=no-self-use,unused-argument
     def reset_password(self, request, *args, **kwargs):
@@ -387,6 +839,7 @@ class PlayerViewSet(viewsets.ModelViewSet):
         new_password = get_random_string(length=20)
         user.set_password(new_password)
         user.save()
+        invalidate_credentials(user)
 
         # TODO put into util function
         # TODO use email template
@@ -417,12 +870,12 @@ class ImageViewSet(viewsets.ModelViewSet):
     filter_fields = ('copyright', 'is_available_publicly', 'owner')
 
     default_random_size = 5
-    default_shuffle_size = 100
 
     # pylint: disable=unused-argument
     def create(self, request, *args, **kwargs):
         if not request.data.get('owner'):
-            request.data['owner'] = get_player(request)
+            player = get_player(request)
+            request.data['owner'] = player.pk if player else None
 
         return super(ImageViewSet, self).create(request, *args, **kwargs)
 
@@ -430,8 +883,16 @@ class ImageViewSet(viewsets.ModelViewSet):
     def retrieve(self, request, *args, **kwargs):
         player = get_player(request)
         image = self.get_object()
+
+        # owners see more fields than everybody else
+        is_owner = bool(player and image.owner_id == player.pk)
+        etag = make_etag('image', image.pk, image.last_modified, is_owner)
+        response = not_modified(request, 'image', etag, image.last_modified)
+        if response is not None:
+            return response
+
         serializer = self.get_serializer(instance=image, player=player)
-        return Response(serializer.data)
+        return set_validators(Response(serializer.data), etag, image.last_modified)
 
     # pylint: disable=unused-argument
     def list(self, request, *args, **kwargs):
@@ -447,55 +908,66 @@ class ImageViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(instance=images, player=player, many=True)
         return Response(serializer.data)
 
-    @list_route(methods=['get', 'post'])
     # pylint: disable=unused-argument
-    def shuffle(self, request, *args, **kwargs):
-        try:
-            size = int(request.query_params.get('size'))
-            size = size if size > 0 else self.default_shuffle_size
-        except (TypeError, ValueError):
-            size = self.default_shuffle_size
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+
+        # the image may still be in use by other identical uploads
+        image = Image.objects.release(instance.pk)
 
-        images = self.get_queryset().order_by('last_modified')
-        for image in images[:size]:
-            image.save()
+        if image is not None:
+            return Response({
+                'deleted': False,
+                'detail': 'image is still in use by other uploads',
+                'ref_count': image.ref_count,
+            })
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @list_route(permission_classes=(permissions.IsAdminUser,))
+    # pylint: disable=no-self-use,unused-argument
+    def dedupe(self, request, *args, **kwargs):
+        return Response(IMAGE_DEDUPE.ratio())
+
+    @detail_route(methods=['get', 'post'], permission_classes=(IsTaskOrAdmin,))
+    # pylint: disable=unused-argument
+    def variants(self, request, pk=None, *args, **kwargs):
+        try:
+            image = Image.objects.get(pk=pk)
+        # pylint: disable=no-member
+        except Image.DoesNotExist as exc:
+            raise_from(NotFound(detail='image "{}" does not exist'.format(pk)), exc)
+
+        variants = Image.objects.create_variants(image)
+        return Response(variants)
+
+    @list_route(methods=['get', 'post'], permission_classes=(IsTaskOrAdmin,))
+    # pylint: disable=no-self-use,unused-argument
+    def pool(self, request, *args, **kwargs):
+        '''rebuild the image pool from a scan of all public images'''
+
+        pool = IMAGE_POOL.scan()
+        return Response({'size': len(pool['pks']), 'count': pool['count']})
+
     @list_route()
     # pylint: disable=unused-argument
     def random(self, request, *args, **kwargs):
         player = get_player(request)
 
-        query = Q(is_available_publicly=True)
-        if player:
-            query |= Q(owner=player)
-
-        images = self.get_queryset().order_by('random_order').filter(query)
-        images = images.reverse() if random.random() < .5 else images
-
         try:
             size = int(request.query_params.get('size'))
             size = size if size > 0 else self.default_random_size
         except (TypeError, ValueError):
             size = self.default_random_size
 
-        paginator = Paginator(images, size * 2, readahead=100)
-        # need to access first page before page_range works
-        paginator.page(1)
-        page_range = list(paginator.page_range)
-        random.shuffle(page_range)
+        pks = IMAGE_POOL.sample(size, player.pk if player else None)
+        images = Image.objects.in_bulk(pks)
 
-        image_list = []
+        # the pool may lag behind deletions and copyright changes
+        image_list = [images[pk] for pk in pks
+                      if pk in images and images[pk].is_available_to(player)]
 
-        for page_num in page_range:
-            image_list.extend(paginator.page(page_num))
-            if len(image_list) >= size:
-                break
-
-        random.shuffle(image_list)
-
-        serializer = self.get_serializer(instance=image_list[:size], many=True)
+        serializer = self.get_serializer(instance=image_list, many=True)
         return Response(serializer.data)
 
 
@@ -511,3 +983,203 @@ class ImageUploadView(views.APIView):
         image = upload_image(request, owner, file_extension)
         serializer = ImageSerializer(instance=image)
         return Response(serializer.data)
+
+
+class SignedUploadView(views.APIView):
+    '''
+    hands out an expiring target to put an image straight into storage and
+    a token to finalize the upload with; pass match and round for match images
+    '''
+
+    # pylint: disable=no-self-use
+    def post(self, request):
+        owner = get_player(request)
+
+        content_type = (normalize_space(request.data.get('content_type'))
+                        or normalize_space(request.query_params.get('content_type'))
+                        or 'image/jpeg')
+        if not content_type.startswith('image/'):
+            raise ValidationError(detail='content type "{}" is not an image'.format(content_type))
+
+        filename = request.data.get('filename') or request.query_params.get('filename')
+        file_extension = (os.path.splitext(filename)[1] if isinstance(filename, string_types)
+                          else None)
+
+        match_pk = request.data.get('match') or request.query_params.get('match')
+        round_number = request.data.get('round') or request.query_params.get('round')
+
+        exclude = ()
+
+        if match_pk or round_number:
+            if owner is None:
+                raise NotAuthenticated(detail='no user')
+            try:
+                match = Match.objects.for_player(owner.pk).get(pk=int(match_pk))
+                if not 0 < int(round_number) <= len(match.rounds_list):
+                    raise ValueError('round out of range')
+                exclude = match.rounds_list[int(round_number) - 1].image_pks(
+                    exclude_player=owner.pk)
+            # pylint: disable=no-member
+            except (TypeError, ValueError, Match.DoesNotExist) as exc:
+                raise_from(ValidationError(detail='invalid match "{}" or round "{}"'
+                                           .format(match_pk, round_number)), exc)
+
+        token = {
+            'owner': owner.pk if owner else None,
+            'match': int(match_pk) if match_pk else None,
+            'round': int(round_number) if round_number else None,
+        }
+
+        # with the content's SHA-256 known images are reused without an upload
+        content_hash = request.data.get('sha256') or request.query_params.get('sha256')
+        duplicate = (Image.objects.find_duplicate(content_hash.lower(), owner, acquire=False,
+                                                  exclude=exclude)
+                     if content_hash else None)
+
+        if duplicate is not None:
+            token['image'] = duplicate.pk
+            return Response({'duplicate': True, 'token': sign_token(token)})
+
+        token['name'] = object_name(file_extension)
+        result = get_upload_storage().target(token['name'], content_type)
+        result['duplicate'] = False
+        result['token'] = sign_token(token)
+
+        return Response(result)
+
+
+class FinalizeUploadView(views.APIView):
+    '''creates the image for a signed upload and submits it to the match round if requested'''
+
+    # pylint: disable=no-self-use
+    def post(self, request):
+        owner = get_player(request)
+        token = request.data.get('token') or request.query_params.get('token')
+
+        try:
+            data = load_token(token)
+        except signing.BadSignature as exc:
+            raise_from(ValidationError(detail='invalid or expired upload token'), exc)
+
+        if data.get('owner') != (owner.pk if owner else None):
+            raise NotAuthenticated(detail='upload token belongs to another player')
+
+        match = round_ = None
+        if data.get('match'):
+            # pylint: disable=no-member
+            match = Match.objects.for_player(owner.pk).get(pk=data['match'])
+            round_ = match.rounds_list[data['round'] - 1]
+
+            # someone else may have submitted the duplicate since the token was signed
+            if data.get('image') and data['image'] in round_.image_pks(exclude_player=owner.pk):
+                raise ValidationError(detail='image already submitted in this round, '
+                                      'upload it without the content hash')
+
+        copyright, info = image_options(request, owner)
+        # retried requests with the same token add no further references
+        receipt = hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+        try:
+            image = (Image.objects.acquire(data['image'], receipt=receipt) if data.get('image')
+                     else Image.objects.create_uploaded_image(
+                         data['name'], receipt=receipt,
+                         exclude=round_.image_pks(exclude_player=owner.pk) if round_ else (),
+                         owner=owner, copyright=copyright, info=info))
+        # pylint: disable=no-member
+        except Image.DoesNotExist as exc:
+            raise_from(NotFound(detail='image does not exist anymore'), exc)
+        except UploadNotFound as exc:
+            raise_from(NotFound(detail='image has not been uploaded'), exc)
+        except ValueError as exc:
+            raise_from(ValidationError(detail=str(exc)), exc)
+
+        if match is None:
+            serializer = ImageSerializer(instance=image, player=owner)
+            return Response(serializer.data)
+
+        story = (normalize_space(request.data.get('story'))
+                 or normalize_space(request.query_params.get('story')))
+
+        try:
+            round_.submit_image(player_pk=owner.pk, image_pk=image.pk, story=story)
+        except ValueError as exc:
+            raise_from(ValidationError(detail=str(exc)), exc)
+        finally:
+            match.check_status()
+            match.save()
+
+        serializer = MatchSerializer(instance=match, player=owner)
+        return Response(serializer.data)
+
+
+class LocalUploadView(views.APIView):
+    '''upload target of the LocalUploads storage stand-in'''
+
+    permission_classes = ()
+    parser_classes = ()
+
+    # pylint: disable=no-self-use
+    def put(self, request, name):
+        storage = get_upload_storage()
+        if not isinstance(storage, LocalUploads):
+            raise NotFound()
+
+        try:
+            data = load_token(request.query_params.get('token'))
+        except signing.BadSignature as exc:
+            raise_from(NotAuthenticated(detail='invalid or expired upload token'), exc)
+
+        if data.get('name') != name:
+            raise NotAuthenticated(detail='upload token is not valid for "{}"'.format(name))
+
+        body = request.body
+        if len(body) > MAX_UPLOAD_SIZE:
+            raise ValidationError(detail='upload is larger than {} bytes'.format(MAX_UPLOAD_SIZE))
+
+        storage.save(name, body)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class StatsView(views.APIView):
+    '''counters of conditional requests and image deduplication'''
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    # pylint: disable=no-self-use,unused-argument
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'conditional': conditional_stats(),
+            'image_dedupe': IMAGE_DEDUPE.ratio(),
+        })
+
+
+class ProfileView(views.APIView):
+    '''the top functions per route of the sampled request profiles'''
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    default_top = 20
+    max_top = 100
+
+    # pylint: disable=no-self-use,unused-argument
+    def get(self, request, *args, **kwargs):
+        try:
+            top = min(max(int(request.query_params.get('top')), 1), self.max_top)
+        except (TypeError, ValueError):
+            top = self.default_top
+
+        try:
+            window_start = (int(request.query_params['window'])
+                            if request.query_params.get('window') else None)
+        except ValueError as exc:
+            raise_from(ValidationError(detail='invalid window'), exc)
+
+        # this instance's samples count, too
+        PROFILER.flush()
+
+        return Response(PROFILER.report(
+            window_start=window_start,
+            route=request.query_params.get('route'),
+            top=top,
+            sort=request.query_params.get('sort') or 'tottime',
+        ))